@@ -1,26 +1,110 @@
 import streamlit as st
 import pandas as pd
 import datetime
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing
 from io import BytesIO
+import hashlib
+import html
+import itertools
+import json
+import math
+import os
+import pickle
+import posixpath
 import random
 import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+import numpy as np
+import openpyxl
 import matplotlib.pyplot as plt
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
 
 # Biblioteca para conexão com SharePoint
 from office365.sharepoint.client_context import ClientContext
-from office365.sharepoint.files.file import File
 from office365.runtime.auth.user_credential import UserCredential
+from office365.runtime.http.request_options import RequestOptions
+from office365.runtime.http.http_method import HttpMethod
+
+# Copy-on-write: as sessões recebem cópias rasas dos DataFrames do cache
+# compartilhado, e qualquer alteração numa sessão não vaza para as demais.
+# Toda escrita é feita direto no DataFrame (df[col] = ..., df.loc/.at[...] = ...)
+# ou em objetos recém-criados; nunca por uma coluna intermediária (df[a][b] = ...,
+# serie = df[col]; serie[...] = ...), que sob copy-on-write não alteraria o df.
+pd.set_option("mode.copy_on_write", True)
 
 ###############################################################################
 # 1) CREDENCIAIS E CAMINHOS NO SHAREPOINT
 ###############################################################################
-EMAIL_REMETENTE = st.secrets["sharepoint"]["email"]
-SENHA_EMAIL = st.secrets["sharepoint"]["password"]
-SITE_URL = st.secrets["sharepoint"]["site_url"]
-
-FILE_URL_FORNECEDORES = st.secrets["sharepoint"]["file_url"]  # Excel de Fornecedores
-FILE_URL_MENSAL_2025 = "/sites/gestaodeprodutos/Documentos Compartilhados/Gestão financeira/Controle mensal de pagamento - 2025 (novo) - Automation.xlsx"
-FILE_URL_MENSAL_2026 = "/sites/gestaodeprodutos/Documentos Compartilhados/Gestão financeira/Controle mensal de pagamento - 2026 (novo) - Automation.xlsx"
+SHAREPOINT_SECRETS = st.secrets.get("sharepoint", {})
+EMAIL_REMETENTE = SHAREPOINT_SECRETS.get("email", "")
+SENHA_EMAIL = SHAREPOINT_SECRETS.get("password", "")
+SITE_URL = SHAREPOINT_SECRETS.get("site_url", "")
+
+# Excel de Fornecedores
+FILE_URL_FORNECEDORES = SHAREPOINT_SECRETS.get(
+    "file_url",
+    "/sites/gestaodeprodutos/Documentos Compartilhados/Gestão financeira/Controle dos Fornecedores - AutomationTest.xlsx",
+)
+
+# Excel de controle mensal: um arquivo por ano, descoberto na pasta pelo padrão
+# do nome (o grupo do padrão é o ano). Os anos são carregados sob demanda.
+PASTA_CONTROLE_MENSAL = SHAREPOINT_SECRETS.get(
+    "pasta_controle_mensal",
+    "/sites/gestaodeprodutos/Documentos Compartilhados/Gestão financeira",
+)
+PADRAO_ARQUIVO_MENSAL = re.compile(SHAREPOINT_SECRETS.get(
+    "padrao_controle_mensal",
+    r"^Controle mensal de pagamento - (\d{4}) \(novo\) - Automation\.xlsx$",
+))
+# Usados só se a pasta não puder ser listada
+FILE_URL_MENSAL_2025 = posixpath.join(PASTA_CONTROLE_MENSAL, "Controle mensal de pagamento - 2025 (novo) - Automation.xlsx")
+FILE_URL_MENSAL_2026 = posixpath.join(PASTA_CONTROLE_MENSAL, "Controle mensal de pagamento - 2026 (novo) - Automation.xlsx")
+
+ARQUIVOS_MENSAIS_PADRAO = {
+    "2025": FILE_URL_MENSAL_2025,
+    "2026": FILE_URL_MENSAL_2026,
+}
+
+# Backend de armazenamento: "sharepoint" (padrão) ou "local" (pasta com os .xlsx,
+# útil para rodar e medir a aplicação sem acesso ao SharePoint)
+STORAGE_SECRETS = st.secrets.get("storage", {})
+STORAGE_BACKEND = STORAGE_SECRETS.get("backend", "sharepoint")
+STORAGE_LOCAL_DIR = STORAGE_SECRETS.get("local_dir", "dados_locais")
+# Cache em disco dos arquivos baixados (reaproveitado enquanto a versão/ETag não mudar)
+STORAGE_CACHE_DIR = STORAGE_SECRETS.get("cache_dir", os.path.join(tempfile.gettempdir(), "synvia_costwatch_cache"))
+
+# Cache em memória compartilhado por todas as sessões (abas do navegador)
+CACHE_SECRETS = st.secrets.get("cache", {})
+CACHE_TTL_SEGUNDOS = CACHE_SECRETS.get("ttl_segundos", 300)
+# Cópia colunar (Feather) das abas já lidas e normalizadas, por versão do arquivo
+CACHE_COLUNAR_ATIVO = CACHE_SECRETS.get("colunar", True)
+# Quantos gráficos renderizados (PNG) ficam guardados para as próximas execuções
+CACHE_GRAFICOS_MAX = CACHE_SECRETS.get("graficos_max", 64)
+# Abas de fornecedores lidas só quando o fornecedor é consultado
+FORNECEDORES_SOB_DEMANDA = CACHE_SECRETS.get("fornecedores_sob_demanda", True)
+
+# Diário local das alterações: o save grava aqui e o envio ao SharePoint é feito
+# em lote, em segundo plano, com novas tentativas enquanto o arquivo estiver bloqueado
+JOURNAL_SECRETS = st.secrets.get("journal", {})
+JOURNAL_CAMINHO = JOURNAL_SECRETS.get("caminho", os.path.join(STORAGE_CACHE_DIR, "journal.sqlite3"))
+JOURNAL_JANELA_SEGUNDOS = JOURNAL_SECRETS.get("janela_segundos", 2.0)
+JOURNAL_BACKOFF_MAX_SEGUNDOS = JOURNAL_SECRETS.get("backoff_max_segundos", 60.0)
 
 ###############################################################################
 # 2) DEFINIÇÃO DE COLUNAS E LISTAS
@@ -112,12 +196,56 @@ MESES_ORDENADOS = [
 MOEDAS_COMUNS = ["REAL", "DOLAR", "EURO"]
 STATUS_PAG_OPCOES = ["PENDENTE", "PAGO"]
 
+# Tipos do controle mensal em memória: categorias para campos de poucos valores,
+# float para valores, ano/mês ordinais e tipos anuláveis (NA em vez de "")
+ESQUEMA_CONTROLE_MENSAL = {
+    "Fornecedor": "category",
+    "ID - Fornecedor": "category",
+    "ID - Pagamento": "string",
+    "Categoria": "category",
+    "Dia Vencimento": "Int8",
+    "Data Envio": "datetime64[ns]",
+    "Data Pagamento": "datetime64[ns]",
+    "Metodo de Pagamento": "category",
+    "Status de Pagamento": "category",
+    "Planejado": "category",
+    "Moeda": "category",
+    "Valor Estimado - Real": "float64",
+    "Valor Pago Convertido": "float64",
+    "Diferença": "float64",
+    "Observações": "string",
+    "Ano": "Int16",
+    "Mes": pd.CategoricalDtype(MESES_ORDENADOS, ordered=True),
+}
+
+# Padrões do formulário "Registrar Pagamentos", usados também em lote/edição
+PADROES_PAGAMENTO = {
+    "Metodo de Pagamento": "CARTÃO",
+    "Status de Pagamento": "PENDENTE",
+    "Planejado": "SIM",
+    "Moeda": "REAL",
+}
+
+# Categorias que já nascem com as opções oferecidas na interface
+CATEGORIAS_CONTROLE_MENSAL = {
+    "Categoria": category_options,
+    "Metodo de Pagamento": ["CARTÃO", "BOLETO"],
+    "Status de Pagamento": STATUS_PAG_OPCOES,
+    "Planejado": ["SIM", "NÃO"],
+    "Moeda": MOEDAS_COMUNS,
+}
+
 ###############################################################################
 # 3) FUNÇÕES AUXILIARES
 ###############################################################################
+# Número aceito depois da limpeza ('1234.56', '-1e3', 'inf'...), igual no Python
+# e no pyarrow: só dígitos ASCII e sem '_' (que float() aceitaria)
+_REGEX_NUMERO = r"(?i)^[+-]?(([0-9]+\.?[0-9]*|\.[0-9]+)(e[+-]?[0-9]+)?|inf|infinity|nan)$"
+
 def parse_float_br(valor_str):
     """
-    Converte string estilo 'R$ 1.234,56' -> 1234.56 (float).
+    Converte string estilo 'R$ 1.234,56' -> 1234.56 (float); texto que não é
+    número (ver _REGEX_NUMERO) vira None.
     """
     if not isinstance(valor_str, str):
         return valor_str
@@ -127,10 +255,9 @@ def parse_float_br(valor_str):
         v = v.replace(",", ".")
     elif "," in v and "." not in v:
         v = v.replace(",", ".")
-    try:
-        return float(v)
-    except ValueError:
+    if not re.match(_REGEX_NUMERO, v):
         return None
+    return float(v)
 
 def _datetime_to_str(data):
     """
@@ -142,6 +269,76 @@ def _datetime_to_str(data):
         return data.strftime("%d/%m/%Y")
     return str(data)
 
+_TIPOS_DATA = (pd.Timestamp, datetime.datetime, datetime.date)
+
+def parse_float_br_series(serie):
+    """
+    Versão vetorizada de parse_float_br para uma coluna inteira: strings
+    'R$ 1.234,56' viram float (inválidas viram NaN); demais valores ficam como estão.
+    As operações de texto rodam no pyarrow (dependência do Streamlit).
+    """
+    tipo = pd.api.types.infer_dtype(serie, skipna=True)
+    if tipo not in ("string", "mixed", "mixed-integer"):
+        return serie
+    eh_str = serie.notna() if tipo == "string" else serie.map(type).eq(str)
+    texto = pa.array(serie.where(eh_str, None), type=pa.string(), from_pandas=True)
+    texto = pc.utf8_trim_whitespace(pc.replace_substring(texto, "R$", ""))
+    # '1.234,56' -> '1234,56'; depois a vírgula decimal vira ponto
+    milhar = pc.and_(pc.match_substring(texto, "."), pc.match_substring(texto, ","))
+    texto = pc.if_else(milhar, pc.replace_substring(texto, ".", ""), texto)
+    texto = pc.replace_substring(texto, ",", ".")
+    texto = pc.if_else(pc.equal(texto, ""), pa.scalar(None, pa.string()), texto)
+    try:
+        convertidos = pc.cast(texto, pa.float64())
+    except pa.ArrowInvalid:
+        # Há textos não numéricos: viram nulos antes da conversão
+        valido = pc.match_substring_regex(texto, _REGEX_NUMERO)
+        convertidos = pc.cast(pc.if_else(valido, texto, pa.scalar(None, pa.string())), pa.float64())
+    numeros = pd.Series(convertidos.to_numpy(zero_copy_only=False), index=serie.index)
+    if tipo == "string":
+        # Só strings e nulos: nulos continuam nulos (NaN)
+        return numeros
+    return serie.where(~eh_str, numeros).infer_objects()
+
+def _formatar_datas_br(datas):
+    """
+    Série datetime64 -> 'DD/MM/AAAA' (NaT vira ''), montada no pyarrow.
+    """
+    arr = pa.array(datas, from_pandas=True)
+    dia = pc.utf8_lpad(pc.cast(pc.day(arr), pa.string()), 2, "0")
+    mes = pc.utf8_lpad(pc.cast(pc.month(arr), pa.string()), 2, "0")
+    ano = pc.cast(pc.year(arr), pa.string())
+    texto = pc.fill_null(pc.binary_join_element_wise(dia, mes, ano, "/"), "")
+    return pd.Series(texto.to_numpy(zero_copy_only=False), index=datas.index, dtype=object)
+
+def datetime_to_str_series(serie):
+    """
+    Versão vetorizada de _datetime_to_str: datas -> 'DD/MM/AAAA', nulos -> '',
+    demais valores -> str(valor).
+    """
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return _formatar_datas_br(serie)
+    if pd.api.types.infer_dtype(serie, skipna=True) in ("string", "empty"):
+        return serie.astype(object).fillna("")
+    valores = serie.astype(object)
+    tipos = valores.map(type)
+    nulos = valores.isna()
+    eh_str = tipos.eq(str)
+    eh_data = tipos.isin(_TIPOS_DATA) & ~nulos
+    resultado = valores.where(eh_str, "")
+    outros = ~(eh_str | eh_data | nulos)
+    if outros.any():
+        resultado[outros] = valores[outros].astype(str)
+    if eh_data.any():
+        datas = pd.to_datetime(valores[eh_data], errors="coerce")
+        texto = _formatar_datas_br(datas)
+        # Datas fora do intervalo do pandas caem no conversor por célula
+        fora = datas.isna()
+        if fora.any():
+            texto[fora] = valores[eh_data][fora].map(_datetime_to_str)
+        resultado[eh_data] = texto
+    return resultado
+
 def parse_date_br(data_str):
     """
     Tenta converter 'DD/MM/AAAA' -> datetime.date (ou None).
@@ -153,231 +350,2850 @@ def parse_date_br(data_str):
     except ValueError:
         return None
 
+# Caracteres que o Excel não aceita em nomes de aba
+CARACTERES_INVALIDOS_ABA = "[]:*?/\\"
+
+def validar_nome_aba(nome):
+    """
+    Mensagem de erro se o Excel não aceitar o nome como aba, ou None.
+    """
+    if not nome.strip():
+        return "O nome da aba não pode ficar vazio."
+    if len(nome) > 31:
+        return "O nome da aba pode ter no máximo 31 caracteres."
+    invalidos = sorted({c for c in nome if c in CARACTERES_INVALIDOS_ABA})
+    if invalidos:
+        return f"O nome da aba não pode conter os caracteres {' '.join(invalidos)}."
+    if nome.startswith("'") or nome.endswith("'"):
+        return "O nome da aba não pode começar nem terminar com apóstrofo."
+    return None
+
+def chave_aba(nome):
+    """
+    Chave para casar nomes de aba: as abas de mês são lidas com strip/upper,
+    então casam sem maiúsculas/espaços; as demais (fornecedores) só pelo nome
+    exato.
+    """
+    if nome.strip().upper() in MESES_ORDENADOS:
+        return nome.strip().casefold()
+    return nome
+
+def prefixo_id_fornecedor(nome):
+    """
+    Prefixo do ID do fornecedor: 3 primeiras letras do nome, ex: 'SYN'.
+    """
+    return re.sub(r"[^A-Za-z]", "", nome).upper()[:3]
+
+def prefixo_id_produto(descricao, categoria):
+    """
+    Prefixo do ID do produto: 3 letras da descrição + 3 da categoria, ex: 'INTTEL'.
+    """
+    d = re.sub(r"[^A-Za-z]", "", descricao).upper()[:3]
+    c = re.sub(r"[^A-Za-z]", "", categoria).upper()[:3]
+    return f"{d}{c}"
+
 def generate_id_fornecedor(nome):
     """
-    Gera ID do fornecedor ex: 'SYN123'.
+    Gera ID do fornecedor ex: 'SYN100' (primeiro número livre, ver reservar_id).
     """
     if not nome:
         return ""
-    prefix = re.sub(r"[^A-Za-z]", "", nome).upper()[:3]
-    rand_num = random.randint(100, 999)
-    return f"{prefix}{rand_num}"
+    return reservar_id("fornecedor", prefixo_id_fornecedor(nome))
 
 def generate_id_produto(descricao, categoria):
     """
-    Gera ID do produto, ex: 'INTTEL456'.
+    Gera ID do produto, ex: 'INTTEL100' (primeiro número livre, ver reservar_id).
     """
     if not descricao or not categoria:
         return ""
-    d = re.sub(r"[^A-Za-z]", "", descricao).upper()[:3]
-    c = re.sub(r"[^A-Za-z]", "", categoria).upper()[:3]
-    rand_num = random.randint(100, 999)
-    return f"{d}{c}{rand_num}"
+    return reservar_id("produto", prefixo_id_produto(descricao, categoria))
 
 ###############################################################################
-# 4) CARREGAR EXCEL DO SHAREPOINT
+# 4) BACKENDS DE ARMAZENAMENTO E CARGA DO EXCEL
 ###############################################################################
-def load_excel_from_sharepoint(file_url):
+class StorageBackend(ABC):
+    """
+    Interface de armazenamento das planilhas: leitura/gravação de bytes,
+    versão (ETag) e listagem de arquivos de uma pasta. Backends sem algum dos
+    métodos falham já ao serem criados.
+    """
+
+    @abstractmethod
+    def open_bytes(self, file_url):
+        ...
+
+    @abstractmethod
+    def save_bytes(self, file_url, content):
+        """
+        Grava e retorna a versão gravada, tirada da própria gravação (ou None
+        se o backend não a informar).
+        """
+
+    @abstractmethod
+    def get_version(self, file_url):
+        """
+        Retorna um identificador que muda a cada gravação (ou None se não existir).
+        """
+
+    @abstractmethod
+    def list_files(self, folder_url):
+        ...
+
+
+class SharePointClient:
+    """
+    Cliente SharePoint de vida longa e thread-safe. Autentica uma vez e reaproveita
+    o token (cookies) enquanto for aceito, mantém conexões keep-alive num pool
+    (requests.Session) e repete requisições com backoff em throttling e falhas
+    transitórias. Registra quantos handshakes foram feitos e a latência.
+    """
+
+    STATUS_RETRY = (429, 500, 502, 503, 504)
+
+    def __init__(self, site_url, email, senha, max_tentativas=4, backoff_segundos=1.0):
+        self.site_url = site_url.rstrip("/")
+        self.email = email
+        self.senha = senha
+        self.max_tentativas = max_tentativas
+        self.backoff_segundos = backoff_segundos
+        self._lock = threading.Lock()
+        self._ctx = None
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self.metricas = {
+            "handshakes": 0,
+            "tempo_handshakes_s": 0.0,
+            "requisicoes": 0,
+            "tempo_requisicoes_s": 0.0,
+            "retentativas": 0,
+        }
+
+    def _autenticar(self):
+        # Chamado com self._lock adquirido
+        inicio = time.perf_counter()
+        ctx = ClientContext(self.site_url).with_credentials(UserCredential(self.email, self.senha))
+        # Força o handshake agora; as próximas requisições reaproveitam os cookies
+        ctx.authentication_context.authenticate_request(RequestOptions(self.site_url))
+        self._ctx = ctx
+        self.metricas["handshakes"] += 1
+        self.metricas["tempo_handshakes_s"] += time.perf_counter() - inicio
+
+    def _preparar(self, request):
+        with self._lock:
+            if self._ctx is None:
+                self._autenticar()
+            # Cabeçalhos de autenticação e, em POST, o X-RequestDigest
+            self._ctx.pending_request().beforeExecute.notify(request)
+
+    def _invalidar_token(self):
+        with self._lock:
+            self._ctx = None
+
+    def _url_arquivo(self, file_url):
+        caminho = file_url.replace("'", "''")
+        return quote(f"{self.site_url}/_api/web/getFileByServerRelativePath(DecodedUrl='{caminho}')", safe=":/")
+
+    def _url_pasta(self, folder_url):
+        caminho = folder_url.replace("'", "''")
+        return quote(f"{self.site_url}/_api/web/getFolderByServerRelativePath(DecodedUrl='{caminho}')", safe=":/")
+
+    def request(self, method, url, data=None, headers=None):
+        tentativa = 0
+        reautenticou = False
+        while True:
+            request = RequestOptions(url, method, data)
+            for nome, valor in (headers or {}).items():
+                request.set_header(nome, valor)
+            self._preparar(request)
+
+            inicio = time.perf_counter()
+            response, erro = None, None
+            try:
+                response = self._session.request(
+                    request.method,
+                    request.url,
+                    data=request.data,
+                    headers=request.headers,
+                    auth=request.auth,
+                    verify=request.verify,
+                    proxies=request.proxies,
+                    timeout=120,
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                erro = e
+            with self._lock:
+                self.metricas["requisicoes"] += 1
+                self.metricas["tempo_requisicoes_s"] += time.perf_counter() - inicio
+
+            if response is not None:
+                # Token expirado: refaz o handshake uma vez
+                if response.status_code in (401, 403) and not reautenticou:
+                    reautenticou = True
+                    self._invalidar_token()
+                    continue
+                if response.status_code not in self.STATUS_RETRY:
+                    response.raise_for_status()
+                    return response
+
+            tentativa += 1
+            if tentativa >= self.max_tentativas:
+                if response is not None:
+                    response.raise_for_status()
+                raise erro
+            espera = self.backoff_segundos * (2 ** (tentativa - 1))
+            if response is not None and response.headers.get("Retry-After", "").isdigit():
+                espera = int(response.headers["Retry-After"])
+            with self._lock:
+                self.metricas["retentativas"] += 1
+            time.sleep(espera)
+
+    def open_bytes(self, file_url):
+        return self.request(HttpMethod.Get, self._url_arquivo(file_url) + "/$value").content
+
+    def save_bytes(self, file_url, content):
+        """
+        Envia o arquivo e retorna o ETag da resposta (None se não vier).
+        """
+        response = self.request(
+            HttpMethod.Post,
+            self._url_arquivo(file_url) + "/$value",
+            data=content,
+            headers={"X-HTTP-Method": "PUT"},
+        )
+        return response.headers.get("ETag")
+
+    def file_properties(self, file_url, campos):
+        url = self._url_arquivo(file_url) + "?$select=" + ",".join(campos)
+        return self.request(HttpMethod.Get, url, headers={"Accept": "application/json;odata=nometadata"}).json()
+
+    def list_folder(self, folder_url):
+        url = self._url_pasta(folder_url) + "/Files?$select=ServerRelativeUrl"
+        resposta = self.request(HttpMethod.Get, url, headers={"Accept": "application/json;odata=nometadata"}).json()
+        return [arq["ServerRelativeUrl"] for arq in resposta.get("value", [])]
+
+
+class SharePointStorage(StorageBackend):
+    """
+    Planilhas hospedadas no SharePoint (caminhos server-relative), acessadas
+    pelo cliente compartilhado.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def open_bytes(self, file_url):
+        return self.client.open_bytes(file_url)
+
+    def save_bytes(self, file_url, content):
+        return self.client.save_bytes(file_url, content)
+
+    def get_version(self, file_url):
+        try:
+            props = self.client.file_properties(file_url, ["ETag", "TimeLastModified"])
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+        return props.get("ETag") or props.get("TimeLastModified")
+
+    def list_files(self, folder_url):
+        return self.client.list_folder(folder_url)
+
+
+class LocalStorage(StorageBackend):
+    """
+    Planilhas numa pasta local: o arquivo é localizado pelo nome (basename) do
+    caminho do SharePoint, então basta copiar os .xlsx para a pasta.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def _path(self, file_url):
+        return os.path.join(self.root_dir, posixpath.basename(file_url))
+
+    def open_bytes(self, file_url):
+        with open(self._path(file_url), "rb") as f:
+            return f.read()
+
+    def save_bytes(self, file_url, content):
+        os.makedirs(self.root_dir, exist_ok=True)
+        destino = self._path(file_url)
+        tmp = destino + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(content)
+            f.flush()
+            info = os.fstat(f.fileno())
+        os.replace(tmp, destino)
+        return f"{info.st_mtime_ns}-{info.st_size}"
+
+    def get_version(self, file_url):
+        try:
+            info = os.stat(self._path(file_url))
+        except FileNotFoundError:
+            return None
+        return f"{info.st_mtime_ns}-{info.st_size}"
+
+    def list_files(self, folder_url):
+        if not os.path.isdir(self.root_dir):
+            return []
+        return [
+            posixpath.join(folder_url, nome)
+            for nome in sorted(os.listdir(self.root_dir))
+            if os.path.isfile(os.path.join(self.root_dir, nome))
+        ]
+
+
+def pasta_privada(caminho):
+    """
+    Cria (se preciso) a pasta só para o usuário do processo (0o700) e a devolve.
+    O que fica nela é carregado sem outra verificação (pickle, SQLite), então
+    pasta de outro usuário é recusada com PermissionError; a própria pasta com
+    acesso de grupo/outros volta a 0o700.
+    """
+    os.makedirs(caminho, mode=0o700, exist_ok=True)
+    if not hasattr(os, "getuid"):
+        return caminho
+    info = os.stat(caminho)
+    if info.st_uid != os.getuid():
+        raise PermissionError(f"pasta '{caminho}' pertence a outro usuário")
+    if info.st_mode & 0o077:
+        os.chmod(caminho, 0o700)
+    return caminho
+
+
+class CachedStorage(StorageBackend):
+    """
+    Cache em disco dos bytes de outro backend, chaveado por URL + versão (ETag).
+    Antes de baixar consulta só os metadados; se a versão não mudou, devolve os
+    bytes já baixados.
+    """
+
+    def __init__(self, backend, cache_dir):
+        self.backend = backend
+        self.cache_dir = cache_dir
+
+    def _dir(self, file_url):
+        return os.path.join(pasta_privada(self.cache_dir), hashlib.sha1(file_url.encode("utf-8")).hexdigest())
+
+    def _path(self, file_url, version):
+        return os.path.join(self._dir(file_url), hashlib.sha1(str(version).encode("utf-8")).hexdigest() + ".xlsx")
+
+    def _store(self, file_url, version, content):
+        pasta = self._dir(file_url)
+        os.makedirs(pasta, exist_ok=True)
+        destino = self._path(file_url, version)
+        # Só a versão mais recente de cada arquivo fica no cache
+        for nome in os.listdir(pasta):
+            if os.path.join(pasta, nome) != destino:
+                try:
+                    os.remove(os.path.join(pasta, nome))
+                except OSError:
+                    pass
+        tmp = f"{destino}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.replace(tmp, destino)
+
+    def open_bytes(self, file_url):
+        version = self.backend.get_version(file_url)
+        if version is not None:
+            try:
+                with open(self._path(file_url, version), "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+        content = self.backend.open_bytes(file_url)
+        if version is not None:
+            self._store(file_url, version, content)
+        return content
+
+    def save_bytes(self, file_url, content):
+        # Só a versão devolvida pela própria gravação identifica estes bytes:
+        # consultar a versão depois poderia pegar a de outro gravador
+        version = self.backend.save_bytes(file_url, content)
+        if version is not None:
+            self._store(file_url, version, content)
+        else:
+            shutil.rmtree(self._dir(file_url), ignore_errors=True)
+        return version
+
+    def get_version(self, file_url):
+        return self.backend.get_version(file_url)
+
+    def list_files(self, folder_url):
+        return self.backend.list_files(folder_url)
+
+
+@st.cache_resource
+def get_sharepoint_client():
+    """
+    Um único cliente autenticado por processo, compartilhado por sessões e threads.
+    """
+    return SharePointClient(SITE_URL, EMAIL_REMETENTE, SENHA_EMAIL)
+
+
+@st.cache_resource
+def get_storage():
+    """
+    Backend configurado em [storage] no secrets.toml. O SharePoint passa pelo
+    cache em disco; a pasta local é lida diretamente.
+    """
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(STORAGE_LOCAL_DIR)
+    return CachedStorage(SharePointStorage(get_sharepoint_client()), STORAGE_CACHE_DIR)
+
+
+class ColumnarCache:
+    """
+    Abas já normalizadas gravadas em disco, chaveadas por URL + versão do arquivo
+    de origem. Cada aba vira um arquivo Feather (lido com memory-map); abas com
+    colunas de tipos misturados, que o Arrow não representa, vão em pickle; por
+    isso tudo fica numa pasta privada do usuário (pasta_privada).
+    """
+
+    # Muda quando a normalização passa a produzir outros tipos/colunas
+    FORMATO = 3
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _dir(self, file_url):
+        return os.path.join(pasta_privada(self.cache_dir), hashlib.sha1(file_url.encode("utf-8")).hexdigest())
+
+    def _dir_versao(self, file_url, version):
+        chave = f"{self.FORMATO}:{version}"
+        return os.path.join(self._dir(file_url), hashlib.sha1(chave.encode("utf-8")).hexdigest())
+
+    def _manifest(self, file_url, version):
+        with open(os.path.join(self._dir_versao(file_url, version), "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def abas(self, file_url, version):
+        """
+        Nomes das abas guardadas, na ordem original, ou None se não houver cache.
+        """
+        try:
+            return [item["nome"] for item in self._manifest(file_url, version)["abas"]]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def ler(self, file_url, version, abas=None):
+        """
+        Dicionário {aba: DataFrame} na ordem original (só as abas pedidas, se
+        abas for informado), ou None se não houver cache.
+        """
+        try:
+            pasta = self._dir_versao(file_url, version)
+            manifest = self._manifest(file_url, version)
+            frames = {}
+            for item in manifest["abas"]:
+                if abas is not None and item["nome"] not in abas:
+                    continue
+                caminho = os.path.join(pasta, item["arquivo"])
+                if item["formato"] == "feather":
+                    frames[item["nome"]] = feather.read_table(caminho, memory_map=True).to_pandas()
+                else:
+                    frames[item["nome"]] = pd.read_pickle(caminho)
+            return frames
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def gravar(self, file_url, version, frames):
+        pasta_url = self._dir(file_url)
+        pasta = self._dir_versao(file_url, version)
+        tmp = f"{pasta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        abas = []
+        for i, (nome, df) in enumerate(frames.items()):
+            arquivo = f"aba_{i}"
+            try:
+                df.to_feather(os.path.join(tmp, arquivo + ".feather"))
+                abas.append({"nome": nome, "arquivo": arquivo + ".feather", "formato": "feather"})
+            except Exception:
+                # O Arrow pode falhar no meio da escrita: não deixa o .feather pela metade
+                try:
+                    os.remove(os.path.join(tmp, arquivo + ".feather"))
+                except OSError:
+                    pass
+                df.to_pickle(os.path.join(tmp, arquivo + ".pkl"))
+                abas.append({"nome": nome, "arquivo": arquivo + ".pkl", "formato": "pickle"})
+        with open(os.path.join(tmp, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"abas": abas}, f, ensure_ascii=False)
+        # Só a versão mais recente de cada arquivo fica no cache
+        for nome in os.listdir(pasta_url):
+            caminho = os.path.join(pasta_url, nome)
+            if caminho not in (tmp, pasta) and not nome.endswith(".tmp"):
+                shutil.rmtree(caminho, ignore_errors=True)
+        try:
+            os.rename(tmp, pasta)
+        except OSError:
+            # Outra thread/processo já gravou esta versão
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_excel_from_sharepoint(file_url, storage=None):
     # Removido spinner aqui para evitar re-runs desnecessários
-    ctx = ClientContext(SITE_URL).with_credentials(UserCredential(EMAIL_REMETENTE, SENHA_EMAIL))
-    response = File.open_binary(ctx, file_url)
-    excel_data = response.content
+    # (storage pode ser passado explicitamente por threads fora do script)
+    storage = storage or get_storage()
+    excel_data = storage.open_bytes(file_url)
     sheets = pd.read_excel(BytesIO(excel_data), sheet_name=None)
     return sheets
 
+def load_normalizado(file_url, storage, normalizar, journal=None, ler_xlsx=None):
+    """
+    Abas do arquivo já normalizadas por normalizar(sheets). Se a versão do
+    arquivo não mudou, lê a cópia colunar em disco e pula o xlsx inteiro.
+    Abas ainda pendentes no diário (journal) substituem as do arquivo.
+    ler_xlsx(bytes), se informado, lê e normaliza o xlsx no lugar de
+    read_excel + normalizar.
+    """
+    cache_colunar = ColumnarCache(os.path.join(STORAGE_CACHE_DIR, "colunar")) if CACHE_COLUNAR_ATIVO else None
+    version = storage.get_version(file_url) if cache_colunar else None
+    frames = cache_colunar.ler(file_url, version) if version is not None else None
+    if frames is None:
+        if ler_xlsx is not None:
+            frames = ler_xlsx(storage.open_bytes(file_url))
+        else:
+            frames = normalizar(load_excel_from_sharepoint(file_url, storage))
+        if version is not None:
+            try:
+                cache_colunar.gravar(file_url, version, frames)
+            except OSError:
+                pass
+    if journal is not None:
+        frames = sobrepor_pendentes(frames, journal.pendentes(file_url), normalizar)
+    return frames
+
+class PlanilhaSobDemanda:
+    """
+    Abas de um arquivo lidas sob demanda: a lista de abas sai do índice do
+    workbook (ou da cópia colunar) e cada aba só é lida e normalizada na
+    primeira consulta, ficando guardada para as seguintes. É compartilhada
+    entre as sessões (cache compartilhado); as sessões recebem cópias rasas.
+    Abas ainda pendentes no diário substituem as do arquivo, como em
+    load_normalizado.
+    """
+
+    def __init__(self, file_url, storage, normalizar, journal=None):
+        self.file_url = file_url
+        self.normalizar = normalizar
+        self._storage = storage
+        self._lock = threading.Lock()
+        self._frames = {}
+        self._do_arquivo = {}
+        self._excel = None
+        self._cache_colunar = ColumnarCache(os.path.join(STORAGE_CACHE_DIR, "colunar")) if CACHE_COLUNAR_ATIVO else None
+        self._version = storage.get_version(file_url) if self._cache_colunar else None
+        nomes_arquivo = self._cache_colunar.abas(file_url, self._version) if self._version is not None else None
+        self._colunar = nomes_arquivo is not None
+        if not self._colunar:
+            self._excel = pd.ExcelFile(BytesIO(storage.open_bytes(file_url)))
+            nomes_arquivo = list(self._excel.sheet_names)
+        self._nomes_arquivo = nomes_arquivo
+
+        # Nomes comparados por chave_aba, como no patch do xlsx
+        pendentes = journal.pendentes(file_url) if journal is not None else {}
+        por_chave = {chave_aba(aba): aba for aba in pendentes}
+        self._pendentes = {}
+        self.nomes = []
+        for nome in nomes_arquivo:
+            aba = por_chave.pop(chave_aba(nome), None)
+            if aba is None:
+                self.nomes.append(nome)
+            elif pendentes[aba] is not None:
+                self.nomes.append(aba)
+                self._pendentes[aba] = pendentes[aba]
+        for aba in por_chave.values():
+            if pendentes[aba] is not None:
+                self.nomes.append(aba)
+                self._pendentes[aba] = pendentes[aba]
+
+    def _ler(self, nome):
+        if nome in self._pendentes:
+            return self.normalizar({nome: self._pendentes[nome].copy()})[nome]
+        if self._colunar:
+            frames = self._cache_colunar.ler(self.file_url, self._version, abas=[nome])
+            if frames is not None and nome in frames:
+                return frames[nome]
+            # Cópia colunar sumiu (nova versão gravada por outro processo): volta ao xlsx
+            self._colunar = False
+            self._excel = pd.ExcelFile(BytesIO(self._storage.open_bytes(self.file_url)))
+        df = self.normalizar({nome: self._excel.parse(nome)})[nome]
+        self._do_arquivo[nome] = df
+        # Arquivo lido por inteiro: grava a cópia colunar para as próximas aberturas
+        if self._version is not None and len(self._do_arquivo) == len(self._nomes_arquivo):
+            try:
+                self._cache_colunar.gravar(
+                    self.file_url, self._version,
+                    {aba: self._do_arquivo[aba] for aba in self._nomes_arquivo}
+                )
+            except OSError:
+                pass
+            self._excel = None
+        return df
+
+    def aba(self, nome):
+        """
+        DataFrame normalizado da aba, lido na primeira chamada.
+        """
+        with self._lock:
+            if nome not in self._frames:
+                if nome not in self.nomes:
+                    raise KeyError(nome)
+                self._frames[nome] = self._ler(nome)
+            return self._frames[nome]
+
+    def carregar_todas(self):
+        for nome in list(self.nomes):
+            self.aba(nome)
+
+    def aplicar(self, alteracoes):
+        """
+        Leva para cá as abas salvas por uma sessão ({aba: DataFrame}, None =
+        excluída), para que as novas sessões já vejam o estado salvo.
+        """
+        with self._lock:
+            for nome, df in alteracoes.items():
+                if df is None:
+                    if nome in self.nomes:
+                        self.nomes.remove(nome)
+                    self._frames.pop(nome, None)
+                else:
+                    if nome not in self.nomes:
+                        self.nomes.append(nome)
+                    self._frames[nome] = df.copy(deep=False)
+
+
+###############################################################################
+# 4.1) ALTERAÇÃO PARCIAL DE PLANILHAS (XLSX)
+###############################################################################
+# Um .xlsx é um zip: cada aba é um XML próprio. Para salvar só as abas alteradas,
+# reescrevemos os XMLs dessas abas (e o índice do workbook) e copiamos o resto
+# do pacote sem mudanças.
+_TIPO_REL_PLANILHA = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"
+_CONTENT_TYPE_PLANILHA = "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"
+_XML_INVALIDO = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+def _coluna_excel(indice):
+    """
+    0 -> 'A', 25 -> 'Z', 26 -> 'AA'.
+    """
+    letras = ""
+    indice += 1
+    while indice:
+        indice, resto = divmod(indice - 1, 26)
+        letras = chr(65 + resto) + letras
+    return letras
+
+def _xml_celula(ref, valor):
+    if valor is None:
+        return ""
+    if isinstance(valor, (bool, np.bool_)):
+        return f'<c r="{ref}" t="b"><v>{int(valor)}</v></c>'
+    if isinstance(valor, (int, np.integer)):
+        return f'<c r="{ref}"><v>{int(valor)}</v></c>'
+    if isinstance(valor, (float, np.floating)):
+        if math.isnan(valor):
+            return ""
+        if math.isfinite(valor):
+            return f'<c r="{ref}"><v>{repr(float(valor))}</v></c>'
+    try:
+        if pd.isna(valor):
+            return ""
+    except (TypeError, ValueError):
+        pass
+    texto = _datetime_to_str(valor) if isinstance(valor, _TIPOS_DATA) else str(valor)
+    if texto == "":
+        return ""
+    texto = html.escape(_XML_INVALIDO.sub("", texto), quote=False)
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+def planilha_xml(df):
+    """
+    XML de uma aba (cabeçalho + linhas) com textos inline, sem depender do
+    sharedStrings.xml do arquivo.
+    """
+    colunas = [_coluna_excel(i) for i in range(len(df.columns))]
+    partes = [
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+    ]
+    cabecalho = "".join(_xml_celula(f"{colunas[i]}1", str(col)) for i, col in enumerate(df.columns))
+    partes.append(f'<row r="1">{cabecalho}</row>')
+    for n, linha in enumerate(df.itertuples(index=False, name=None), start=2):
+        celulas = "".join(_xml_celula(f"{colunas[i]}{n}", valor) for i, valor in enumerate(linha))
+        partes.append(f'<row r="{n}">{celulas}</row>')
+    partes.append("</sheetData></worksheet>")
+    return "".join(partes).encode("utf-8")
+
+def _atributos(tag):
+    return {nome: html.unescape(valor) for nome, valor in re.findall(r'([\w:]+)="([^"]*)"', tag)}
+
+def _caminho_parte(target):
+    if target.startswith("/"):
+        return target.lstrip("/")
+    return posixpath.normpath(posixpath.join("xl", target))
+
+def _rels_da_parte(caminho):
+    pasta, nome = posixpath.split(caminho)
+    return posixpath.join(pasta, "_rels", nome + ".rels")
+
+def patch_workbook(conteudo, alteracoes):
+    """
+    Aplica alterações por aba num .xlsx existente e devolve os novos bytes.
+    alteracoes: {nome_da_aba: DataFrame (substitui ou cria a aba) ou None (exclui)}.
+    As abas não citadas têm o conteúdo preservado exatamente como estava.
+    Lança ValueError se a estrutura do arquivo não for a esperada.
+    """
+    zin = zipfile.ZipFile(BytesIO(conteudo))
+    wb = zin.read("xl/workbook.xml").decode("utf-8")
+    rels = zin.read("xl/_rels/workbook.xml.rels").decode("utf-8")
+    tipos = zin.read("[Content_Types].xml").decode("utf-8")
+    nomes_zip = set(zin.namelist())
+
+    bloco = re.search(r"<(\w+:)?sheets\b[^>]*>(.*?)</(?:\w+:)?sheets>", wb, re.S)
+    if bloco is None:
+        raise ValueError("workbook.xml sem <sheets>")
+    prefixo = bloco.group(1) or ""
+    fim_sheets = f"</{prefixo}sheets>"
+    if "</Relationships>" not in rels or "</Types>" not in tipos or fim_sheets not in wb:
+        raise ValueError("estrutura do pacote não suportada")
+
+    relacoes = {}
+    for el in re.findall(r"<(?:\w+:)?Relationship\b[^>]*/>", rels):
+        attrs = _atributos(el)
+        relacoes[attrs["Id"]] = (el, attrs.get("Target", ""), attrs.get("Type", ""))
+
+    abas = []
+    for el in re.findall(r"<(?:\w+:)?sheet\b[^>]*/>", bloco.group(2)):
+        attrs = _atributos(el)
+        attr_rid = next(k for k in attrs if k.endswith(":id"))
+        abas.append({"nome": attrs["name"], "xml": el, "rid": attrs[attr_rid], "attr_rid": attr_rid, "sheet_id": int(attrs["sheetId"])})
+    attr_rid = abas[0]["attr_rid"] if abas else "r:id"
+
+    novos = {}
+    removidos = set()
+    for nome, df in alteracoes.items():
+        # As abas de mês são lidas com strip/upper, então casam sem
+        # maiúsculas/espaços (chave_aba); as de fornecedor, só pelo nome exato
+        aba = next((a for a in abas if a["nome"] == nome), None)
+        if aba is None:
+            aba = next((a for a in abas if chave_aba(a["nome"]) == chave_aba(nome)), None)
+        if aba is None and df is not None:
+            # O Excel não abre arquivos com nome de aba inválido ou repetido
+            # (sem diferenciar maiúsculas)
+            erro = validar_nome_aba(nome)
+            if erro:
+                raise ValueError(f"aba '{nome}': {erro}")
+            if any(a["nome"].casefold() == nome.casefold() for a in abas):
+                raise ValueError(f"aba '{nome}': já existe uma aba com esse nome")
+        if aba is not None:
+            rel_el, target, _ = relacoes[aba["rid"]]
+            caminho = _caminho_parte(target)
+            # A aba é reescrita do zero: desenhos/tabelas ligados a ela saem junto
+            removidos.add(_rels_da_parte(caminho))
+        if df is None:
+            if aba is None:
+                continue
+            posicao = abas.index(aba)
+            removidos.add(caminho)
+            wb = wb.replace(aba["xml"], "", 1)
+            rels = rels.replace(rel_el, "", 1)
+            tipos = re.sub(rf'<Override\b[^>]*PartName="/{re.escape(caminho)}"[^>]*/>', "", tipos)
+
+            def _ajustar_nome_definido(m, posicao=posicao):
+                local = re.search(r'localSheetId="(\d+)"', m.group(0))
+                if local is None:
+                    return m.group(0)
+                indice = int(local.group(1))
+                if indice == posicao:
+                    return ""
+                if indice > posicao:
+                    return m.group(0).replace(local.group(0), f'localSheetId="{indice - 1}"', 1)
+                return m.group(0)
+
+            wb = re.sub(r"<(?:\w+:)?definedName\b[^>]*>.*?</(?:\w+:)?definedName>", _ajustar_nome_definido, wb, flags=re.S)
+            wb = re.sub(r'\b(activeTab|firstSheet)="\d+"', r'\1="0"', wb)
+            abas.remove(aba)
+        elif aba is not None:
+            novos[caminho] = planilha_xml(df)
+        else:
+            n = 1
+            while f"xl/worksheets/sheet{n}.xml" in nomes_zip | set(novos):
+                n += 1
+            caminho = f"xl/worksheets/sheet{n}.xml"
+            r = 1
+            while f"rId{r}" in relacoes:
+                r += 1
+            rid = f"rId{r}"
+            sheet_id = max([a["sheet_id"] for a in abas] + [0]) + 1
+            rel_el = f'<Relationship Id="{rid}" Type="{_TIPO_REL_PLANILHA}" Target="/{caminho}"/>'
+            relacoes[rid] = (rel_el, "/" + caminho, _TIPO_REL_PLANILHA)
+            rels = rels.replace("</Relationships>", rel_el + "</Relationships>", 1)
+            tipos = tipos.replace("</Types>", f'<Override PartName="/{caminho}" ContentType="{_CONTENT_TYPE_PLANILHA}"/></Types>', 1)
+            el = f'<{prefixo}sheet name="{html.escape(nome, quote=True)}" sheetId="{sheet_id}" {attr_rid}="{rid}"/>'
+            wb = wb.replace(fim_sheets, el + fim_sheets, 1)
+            abas.append({"nome": nome, "xml": el, "rid": rid, "attr_rid": attr_rid, "sheet_id": sheet_id})
+            novos[caminho] = planilha_xml(df)
+
+    # A cadeia de cálculo referencia células das abas alteradas; o Excel a recria
+    if "xl/calcChain.xml" in nomes_zip and alteracoes:
+        removidos.add("xl/calcChain.xml")
+        for rid, (rel_el, _, tipo_rel) in list(relacoes.items()):
+            if tipo_rel.endswith("/calcChain"):
+                rels = rels.replace(rel_el, "", 1)
+        tipos = re.sub(r'<Override\b[^>]*PartName="/xl/calcChain.xml"[^>]*/>', "", tipos)
+
+    saida = BytesIO()
+    with zipfile.ZipFile(saida, "w", zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            if info.filename in removidos:
+                continue
+            if info.filename in novos:
+                zout.writestr(info, novos.pop(info.filename))
+            elif info.filename == "xl/workbook.xml":
+                zout.writestr(info, wb.encode("utf-8"))
+            elif info.filename == "xl/_rels/workbook.xml.rels":
+                zout.writestr(info, rels.encode("utf-8"))
+            elif info.filename == "[Content_Types].xml":
+                zout.writestr(info, tipos.encode("utf-8"))
+            else:
+                zout.writestr(info, zin.read(info.filename))
+        for caminho, xml in novos.items():
+            zout.writestr(caminho, xml)
+    return saida.getvalue()
+
+def workbook_completo(abas):
+    """
+    Gera o workbook inteiro (uma aba por item do dicionário).
+    """
+    output = BytesIO()
+    with pd.ExcelWriter(output) as writer:
+        for sheet_name, df in abas.items():
+            # Replace NaN with blank
+            df.fillna("").to_excel(writer, sheet_name=sheet_name, index=False)
+    return output.getvalue()
+
+def conteudo_com_alteracoes(storage, file_url, alteracoes):
+    """
+    Bytes do arquivo com as abas alteradas/incluídas/excluídas, partindo do
+    arquivo atual. Se ele ainda não existir, o workbook é gerado só com as
+    abas alteradas. Um arquivo existente que não pode ser alterado no lugar
+    gera erro: reescrevê-lo só com as abas do diário apagaria as demais.
+    """
+    if storage.get_version(file_url) is None:
+        return workbook_completo({nome: df for nome, df in alteracoes.items() if df is not None})
+    return patch_workbook(storage.open_bytes(file_url), alteracoes)
+
+###############################################################################
+# 4.2) CACHE COMPARTILHADO ENTRE SESSÕES
+###############################################################################
+class SharedDataCache:
+    """
+    Dados carregados uma única vez por processo e compartilhados por todas as
+    sessões, com expiração (TTL). Os saves atualizam ou invalidam as entradas.
+    """
+
+    def __init__(self, ttl_segundos):
+        self.ttl_segundos = ttl_segundos
+        self._lock = threading.Lock()
+        self._entradas = {}
+        self._locks_carga = {}
+
+    def get(self, chave):
+        """
+        Valor da chave, ou None se ausente/expirado.
+        """
+        with self._lock:
+            entrada = self._entradas.get(chave)
+        if entrada is None:
+            return None
+        instante, valor = entrada
+        if time.monotonic() - instante > self.ttl_segundos:
+            return None
+        return valor
+
+    def set(self, chave, valor):
+        with self._lock:
+            self._entradas[chave] = (time.monotonic(), valor)
+
+    def invalidate(self, chave=None):
+        with self._lock:
+            if chave is None:
+                self._entradas.clear()
+            else:
+                self._entradas.pop(chave, None)
+
+    def carregando(self, chave):
+        """
+        Lock por chave: sessões que abrem juntas esperam a primeira carga em vez
+        de baixar os mesmos arquivos em paralelo.
+        """
+        with self._lock:
+            return self._locks_carga.setdefault(chave, threading.Lock())
+
+
+@st.cache_resource
+def get_cache_compartilhado():
+    return SharedDataCache(CACHE_TTL_SEGUNDOS)
+
+
+###############################################################################
+# 4.3) DIÁRIO LOCAL DE ALTERAÇÕES (ENVIO EM LOTE AO SHAREPOINT)
+###############################################################################
+class JournalAlteracoes:
+    """
+    Diário local (SQLite) das abas alteradas, gravado antes do envio ao
+    SharePoint. Uma thread faz o envio: junta as entradas pendentes de cada
+    arquivo (a última versão de cada aba vence), aplica tudo num único patch e
+    upload e só então apaga as entradas enviadas. Arquivo bloqueado (423) ou
+    qualquer outro erro mantém as entradas e agenda nova tentativa com backoff
+    exponencial, então nada se perde.
+
+    Os saves da interface entram por enfileirar(): as abas são preparadas e
+    gravadas no diário antes de ele retornar, e só o envio fica em segundo
+    plano; um erro na preparação/gravação chega a quem salvou. O status de
+    cada trabalho vai de "queued" a "uploading" e termina em "done" ou
+    "failed" (que volta a "uploading" na próxima tentativa).
+    """
+
+    # Trabalhos concluídos guardados em memória para consulta de status
+    MAX_TRABALHOS = 500
+
+    def __init__(self, caminho, storage, janela_segundos=2.0, backoff_segundos=2.0, backoff_max_segundos=60.0):
+        self.caminho = caminho
+        self.storage = storage
+        self.janela_segundos = janela_segundos
+        self.backoff_segundos = backoff_segundos
+        self.backoff_max_segundos = backoff_max_segundos
+        self._lock = threading.Lock()
+        self._evento = threading.Event()
+        # file_url -> {"tentativas", "proxima_tentativa", "ultimo_erro", "bloqueado"}
+        self._falhas = {}
+        self._ids = itertools.count(1)
+        # id -> {"arquivo", "status", "criado_em", "atualizado_em", "erro"}
+        self._trabalhos = {}
+        # As abas vão no diário em pickle: só numa pasta que ninguém mais grava
+        pasta_privada(os.path.dirname(os.path.abspath(caminho)))
+        with closing(self._conectar()) as con, con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS entradas ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, file_url TEXT NOT NULL, "
+                "aba TEXT NOT NULL, conteudo BLOB, criado_em REAL NOT NULL, trabalho INTEGER)"
+            )
+            # Diários criados antes da coluna de trabalho
+            colunas = [linha[1] for linha in con.execute("PRAGMA table_info(entradas)")]
+            if "trabalho" not in colunas:
+                con.execute("ALTER TABLE entradas ADD COLUMN trabalho INTEGER")
+        threading.Thread(target=self._loop, name="journal-envio", daemon=True).start()
+        # Entradas que sobraram de uma execução anterior são enviadas já
+        if self._arquivos_pendentes():
+            self._evento.set()
+
+    def _conectar(self):
+        con = sqlite3.connect(self.caminho, timeout=30)
+        con.execute("PRAGMA journal_mode=WAL")
+        return con
+
+    def registrar(self, file_url, alteracoes, trabalho=None):
+        """
+        Grava {aba: DataFrame ou None (exclusão)} no diário e acorda o envio.
+        """
+        agora = time.time()
+        linhas = [
+            (file_url, aba, None if df is None else pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL), agora, trabalho)
+            for aba, df in alteracoes.items()
+        ]
+        with closing(self._conectar()) as con, con:
+            con.executemany(
+                "INSERT INTO entradas (file_url, aba, conteudo, criado_em, trabalho) VALUES (?, ?, ?, ?, ?)", linhas
+            )
+        self._evento.set()
+
+    def enfileirar(self, file_url, alteracoes, preparar=None):
+        """
+        Grava um save no diário e devolve o id do trabalho de envio.
+        preparar(df), se informado, roda para cada aba antes de gravar. Erros
+        de preparação/gravação são repassados: nada fica no diário e o chamador
+        deve manter as alterações como pendentes.
+        """
+        if preparar is not None:
+            alteracoes = {aba: None if df is None else preparar(df) for aba, df in alteracoes.items()}
+        trabalho = next(self._ids)
+        self._atualizar_trabalho(trabalho, "queued", arquivo=file_url)
+        try:
+            self.registrar(file_url, alteracoes, trabalho)
+        except Exception:
+            with self._lock:
+                self._trabalhos.pop(trabalho, None)
+            raise
+        return trabalho
+
+    def _atualizar_trabalho(self, trabalho, status, arquivo=None, erro=None):
+        agora = time.time()
+        with self._lock:
+            info = self._trabalhos.setdefault(trabalho, {"arquivo": arquivo, "criado_em": agora})
+            info.update(status=status, atualizado_em=agora, erro=erro)
+            if len(self._trabalhos) > self.MAX_TRABALHOS:
+                antigos = [t for t, i in self._trabalhos.items() if i["status"] == "done"]
+                for t in antigos[:len(self._trabalhos) - self.MAX_TRABALHOS]:
+                    del self._trabalhos[t]
+
+    def status_trabalhos(self, trabalhos):
+        """
+        Status dos trabalhos pedidos (os que ainda estão em memória).
+        """
+        with self._lock:
+            return [dict(self._trabalhos[t], id=t) for t in trabalhos if t in self._trabalhos]
+
+    def _entradas(self, file_url):
+        """
+        (maior id lido, {aba: DataFrame ou None}, trabalhos incluídos) com só a
+        última entrada de cada aba.
+        """
+        with closing(self._conectar()) as con:
+            linhas = con.execute(
+                "SELECT id, aba, conteudo, trabalho FROM entradas WHERE file_url = ? ORDER BY id", (file_url,)
+            ).fetchall()
+        alteracoes = {}
+        for _, aba, conteudo, _ in linhas:
+            alteracoes.pop(aba, None)
+            alteracoes[aba] = None if conteudo is None else pickle.loads(conteudo)
+        trabalhos = {linha[3] for linha in linhas if linha[3] is not None}
+        return (linhas[-1][0] if linhas else None), alteracoes, trabalhos
+
+    def pendentes(self, file_url):
+        return self._entradas(file_url)[1]
+
+    def _arquivos_pendentes(self):
+        with closing(self._conectar()) as con:
+            return [linha[0] for linha in con.execute("SELECT DISTINCT file_url FROM entradas")]
+
+    def situacao(self):
+        """
+        Uma linha por arquivo com alterações ainda não enviadas.
+        """
+        with closing(self._conectar()) as con:
+            contagens = con.execute(
+                "SELECT file_url, COUNT(*), MIN(criado_em) FROM entradas GROUP BY file_url"
+            ).fetchall()
+        with self._lock:
+            falhas = {url: dict(info) for url, info in self._falhas.items()}
+        linhas = []
+        for file_url, quantidade, desde in contagens:
+            falha = falhas.get(file_url, {})
+            linhas.append({
+                "arquivo": file_url,
+                "pendentes": quantidade,
+                "desde": desde,
+                "tentativas": falha.get("tentativas", 0),
+                "bloqueado": falha.get("bloqueado", False),
+                "ultimo_erro": falha.get("ultimo_erro"),
+                "proxima_tentativa": falha.get("proxima_tentativa"),
+            })
+        return linhas
+
+    def _enviar(self, file_url):
+        ultimo_id, alteracoes, trabalhos = self._entradas(file_url)
+        if ultimo_id is None:
+            return
+        for trabalho in trabalhos:
+            self._atualizar_trabalho(trabalho, "uploading")
+        try:
+            conteudo = conteudo_com_alteracoes(self.storage, file_url, alteracoes)
+            self.storage.save_bytes(file_url, conteudo)
+        except Exception as e:
+            for trabalho in trabalhos:
+                self._atualizar_trabalho(trabalho, "failed", erro=str(e))
+            with self._lock:
+                falha = self._falhas.setdefault(file_url, {"tentativas": 0})
+                falha["tentativas"] += 1
+                falha["ultimo_erro"] = str(e)
+                falha["bloqueado"] = "Locked" in str(e) or "423" in str(e)
+                espera = min(self.backoff_max_segundos, self.backoff_segundos * 2 ** (falha["tentativas"] - 1))
+                falha["proxima_tentativa"] = time.time() + espera
+            return
+        # Só apaga o que foi enviado; entradas gravadas durante o envio ficam
+        with closing(self._conectar()) as con, con:
+            con.execute("DELETE FROM entradas WHERE file_url = ? AND id <= ?", (file_url, ultimo_id))
+        with self._lock:
+            self._falhas.pop(file_url, None)
+        for trabalho in trabalhos:
+            self._atualizar_trabalho(trabalho, "done")
+
+    def _espera(self):
+        with self._lock:
+            proximas = [f["proxima_tentativa"] for f in self._falhas.values()]
+        return max(0.0, min(proximas) - time.time()) if proximas else None
+
+    def _loop(self):
+        while True:
+            self._evento.wait(timeout=self._espera())
+            self._evento.clear()
+            # Espera um pouco para juntar edições seguidas num só envio
+            time.sleep(self.janela_segundos)
+            for file_url in self._arquivos_pendentes():
+                with self._lock:
+                    proxima = self._falhas.get(file_url, {}).get("proxima_tentativa", 0)
+                if proxima <= time.time():
+                    self._enviar(file_url)
+
+
+@st.cache_resource
+def get_journal():
+    return JournalAlteracoes(
+        JOURNAL_CAMINHO,
+        get_storage(),
+        janela_segundos=JOURNAL_JANELA_SEGUNDOS,
+        backoff_max_segundos=JOURNAL_BACKOFF_MAX_SEGUNDOS,
+    )
+
+
+def sobrepor_pendentes(frames, pendentes, normalizar):
+    """
+    Aplica sobre as abas lidas do arquivo as abas ainda pendentes no diário
+    (normalizadas do mesmo jeito). Nomes comparados por chave_aba, como no
+    patch do xlsx.
+    """
+    if not pendentes:
+        return frames
+    novos = normalizar({aba: df.copy() for aba, df in pendentes.items() if df is not None})
+    por_chave = {chave_aba(aba): aba for aba in pendentes}
+    resultado = {}
+    # Abas alteradas ficam na posição original; as novas vão para o fim
+    for nome, df in frames.items():
+        aba = por_chave.pop(chave_aba(nome), None)
+        if aba is None:
+            resultado[nome] = df
+        elif aba in novos:
+            resultado[aba] = novos[aba]
+    for aba in por_chave.values():
+        if aba in novos:
+            resultado[aba] = novos[aba]
+    return resultado
+
+
+def snapshot_controle_mensal(df):
+    return df.copy(deep=False)
+
 ###############################################################################
 # 5) CÓDIGO PARA FORNECEDORES
 ###############################################################################
+def _normalizar_fornecedores(all_sheets):
+    """
+    Padroniza colunas e tipos de cada aba (fornecedor) lida do Excel.
+    """
+    results = {}
+    for sheet_name, df in all_sheets.items():
+        df.columns = df.columns.str.strip()
+        for col in ALL_COLUMNS:
+            if col not in df.columns:
+                df[col] = ""
+        if "CNPJ" in df.columns:
+            df["CNPJ"] = df["CNPJ"].astype(str)
+        if "Contato" in df.columns:
+            df["Contato"] = df["Contato"].astype(str)
+        if "Inicio do contrato" in df.columns:
+            df["Inicio do contrato"] = datetime_to_str_series(df["Inicio do contrato"])
+        if "Termino do contrato" in df.columns:
+            df["Termino do contrato"] = datetime_to_str_series(df["Termino do contrato"])
+        if "Início do Pagamento" in df.columns:
+            df["Início do Pagamento"] = datetime_to_str_series(df["Início do Pagamento"])
+        if "Valor mensal" in df.columns:
+            df["Valor mensal"] = parse_float_br_series(df["Valor mensal"])
+        if "Valor do plano" in df.columns:
+            df["Valor do plano"] = parse_float_br_series(df["Valor do plano"])
+        # Adiciona cada aba no dicionário final
+        results[sheet_name] = df
+    return results
+
+class FornecedoresSessao(MutableMapping):
+    """
+    suppliers_data da sessão: dicionário aba -> DataFrame sobre uma
+    PlanilhaSobDemanda. As chaves (fornecedores) já estão todas disponíveis, mas
+    a aba de um fornecedor só é lida quando ele é consultado; percorrer os
+    valores (catálogo completo) lê as que faltarem. O que a sessão altera fica
+    só nela até o save.
+    """
+
+    def __init__(self, planilha):
+        self._planilha = planilha
+        self._nomes = list(planilha.nomes)
+        self._frames = {}
+
+    def __getitem__(self, nome):
+        if nome not in self._frames:
+            if nome not in self._nomes:
+                raise KeyError(nome)
+            self._frames[nome] = self._planilha.aba(nome).copy(deep=False)
+        return self._frames[nome]
+
+    def __setitem__(self, nome, df):
+        if nome not in self._nomes:
+            self._nomes.append(nome)
+        self._frames[nome] = df
+
+    def __delitem__(self, nome):
+        self._nomes.remove(nome)
+        self._frames.pop(nome, None)
+
+    def __iter__(self):
+        return iter(list(self._nomes))
+
+    def __len__(self):
+        return len(self._nomes)
+
+    def __contains__(self, nome):
+        return nome in self._nomes
+
+    @property
+    def todas_carregadas(self):
+        return len(self._frames) == len(self._nomes)
+
+def _ler_fornecedores(storage, journal=None):
+    planilha = PlanilhaSobDemanda(FILE_URL_FORNECEDORES, storage, _normalizar_fornecedores, journal)
+    if not FORNECEDORES_SOB_DEMANDA:
+        planilha.carregar_todas()
+    return planilha
+
 def load_fornecedores():
     # Evitar spinner dentro de função que roda ao iniciar a app
+    cache = get_cache_compartilhado()
     try:
-        all_sheets = load_excel_from_sharepoint(FILE_URL_FORNECEDORES)
-        results = {}
-        for sheet_name, df in all_sheets.items():
-            df.columns = df.columns.str.strip()
-            for col in ALL_COLUMNS:
-                if col not in df.columns:
-                    df[col] = ""
-            if "CNPJ" in df.columns:
-                df["CNPJ"] = df["CNPJ"].astype(str)
-            if "Contato" in df.columns:
-                df["Contato"] = df["Contato"].astype(str)
-            if "Inicio do contrato" in df.columns:
-                df["Inicio do contrato"] = df["Inicio do contrato"].apply(_datetime_to_str)
-            if "Termino do contrato" in df.columns:
-                df["Termino do contrato"] = df["Termino do contrato"].apply(_datetime_to_str)
-            if "Início do Pagamento" in df.columns:
-                df["Início do Pagamento"] = df["Início do Pagamento"].apply(_datetime_to_str)
-            if "Valor mensal" in df.columns:
-                df["Valor mensal"] = df["Valor mensal"].apply(parse_float_br)
-            if "Valor do plano" in df.columns:
-                df["Valor do plano"] = df["Valor do plano"].apply(parse_float_br)
-            # Adiciona cada aba no dicionário final
-            results[sheet_name] = df
-        return results
+        with cache.carregando("fornecedores"):
+            planilha = cache.get("fornecedores")
+            if planilha is None:
+                planilha = _ler_fornecedores(get_storage(), get_journal())
+                cache.set("fornecedores", planilha)
+        return FornecedoresSessao(planilha)
     except Exception as e:
         st.error(f"Erro ao carregar Fornecedores: {e}")
         return {}
 
+def montar_catalogo(fornecedores):
+    """
+    Tabela única fornecedor/produto, com a coluna-chave "Aba (Fornecedor)",
+    montada com um só concat sobre todas as abas.
+    """
+    if not fornecedores:
+        return pd.DataFrame(columns=["Aba (Fornecedor)"] + ALL_COLUMNS)
+    catalogo = pd.concat(
+        list(fornecedores.values()),
+        keys=list(fornecedores.keys()),
+        names=["Aba (Fornecedor)", None],
+    )
+    return catalogo.reset_index(level=0).reset_index(drop=True)
+
+def catalogo_fornecedores():
+    """
+    Catálogo da sessão; é montado na primeira leitura e depois só atualizado
+    por fornecedor (ver atualizar_catalogo).
+    """
+    if "catalogo_fornecedores" not in st.session_state:
+        st.session_state.catalogo_fornecedores = montar_catalogo(st.session_state.suppliers_data)
+    return st.session_state.catalogo_fornecedores
+
+def atualizar_catalogo(nome):
+    """
+    Substitui no catálogo só o bloco de linhas do fornecedor, mantendo a posição
+    dele; se o fornecedor não existe mais em suppliers_data, o bloco é removido.
+    """
+    catalogo = st.session_state.get("catalogo_fornecedores")
+    if catalogo is None:
+        return
+    posicoes = np.flatnonzero(catalogo["Aba (Fornecedor)"].to_numpy() == nome)
+    if len(posicoes):
+        inicio, fim = posicoes[0], posicoes[-1] + 1
+    else:
+        inicio = fim = len(catalogo)
+
+    novo = None
+    df = st.session_state.suppliers_data.get(nome)
+    if df is not None:
+        novo = df.copy(deep=False)
+        novo.insert(0, "Aba (Fornecedor)", nome)
+    st.session_state.catalogo_fornecedores = pd.concat(
+        [catalogo.iloc[:inicio], novo, catalogo.iloc[fim:]], ignore_index=True
+    )
+
+def produtos_do_fornecedor(nome):
+    """
+    Índice ID - Pagamento -> Descrição do Produto de um fornecedor, montado na
+    primeira consulta e descartado quando a aba do fornecedor muda.
+    """
+    indices = st.session_state.setdefault("indice_produtos", {})
+    if nome not in indices:
+        df = st.session_state.suppliers_data.get(nome)
+        produtos = {}
+        if df is not None and "ID - Pagamento" in df.columns:
+            unicos = df.dropna(subset=["ID - Pagamento"]).drop_duplicates("ID - Pagamento")
+            descricoes = unicos["Descrição do Produto"] if "Descrição do Produto" in unicos.columns else pd.Series("", index=unicos.index)
+            produtos = {id_pag: desc for id_pag, desc in zip(unicos["ID - Pagamento"], descricoes) if id_pag}
+        indices[nome] = produtos
+    return indices[nome]
+
+def ids_por_fornecedor(fornecedores, nomes=None):
+    """
+    Nome do fornecedor -> ID - Fornecedor (da primeira linha da aba). Com nomes,
+    só esses fornecedores são consultados (e só as abas deles são lidas).
+    """
+    if nomes is not None:
+        fornecedores = {nome: fornecedores[nome] for nome in set(nomes) if nome in fornecedores}
+    return {
+        nome: aba.iloc[0]["ID - Fornecedor"]
+        for nome, aba in fornecedores.items()
+        if not aba.empty and "ID - Fornecedor" in aba.columns
+    }
+
+class RegistroIds:
+    """
+    IDs de fornecedor e de produto em uso em todas as abas, com consulta O(1),
+    compartilhado entre as sessões do processo (ver registro_ids). Os IDs novos
+    são determinísticos: prefixo + o menor número (a partir de 100) que não
+    está em uso nem reservado com aquele prefixo.
+
+    Cada sessão reserva no máximo um ID por tipo (ver reservar): pedir outro
+    prefixo libera o anterior, e reservas sem uso expiram.
+    """
+
+    COLUNAS = {"fornecedor": "ID - Fornecedor", "produto": "ID - Produto"}
+    NUMERO_INICIAL = 100
+    # Reserva sem uso (sessão fechada, formulário abandonado) expira depois disso
+    RESERVA_SEGUNDOS = 30 * 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # tipo -> ID -> {aba: ocorrências}
+        self._usos = {tipo: {} for tipo in self.COLUNAS}
+        self._por_aba = {}
+        # tipo -> dono (sessão) -> (prefixo, ID, instante): IDs entregues e ainda não gravados
+        self._reservas = {tipo: {} for tipo in self.COLUNAS}
+        self.montado = False
+
+    def montar(self, fornecedores):
+        """
+        Registra todas as abas (só na primeira chamada).
+        """
+        with self._lock:
+            if self.montado:
+                return
+            for nome, df in fornecedores.items():
+                self._atualizar(nome, df)
+            self.montado = True
+
+    @staticmethod
+    def _contar(df, coluna):
+        if df is None or df.empty or coluna not in df.columns:
+            return {}
+        ids = df[coluna].dropna().astype(str).str.strip()
+        return ids[ids != ""].value_counts().to_dict()
+
+    def atualizar(self, nome, df):
+        """
+        Troca os IDs registrados da aba pelos do DataFrame (None remove a aba).
+        Antes de montado não faz nada: a montagem já lê as abas salvas.
+        """
+        with self._lock:
+            if self.montado:
+                self._atualizar(nome, df)
+
+    def _atualizar(self, nome, df):
+        for tipo, contagem in self._por_aba.pop(nome, {}).items():
+            usos = self._usos[tipo]
+            for id_ in contagem:
+                abas = usos[id_]
+                abas.pop(nome, None)
+                if not abas:
+                    del usos[id_]
+        if df is None:
+            return
+        por_tipo = {}
+        for tipo, coluna in self.COLUNAS.items():
+            contagem = self._contar(df, coluna)
+            # Todas as linhas da aba repetem o ID do fornecedor: conta uma vez
+            if tipo == "fornecedor":
+                contagem = dict.fromkeys(contagem, 1)
+            for id_, n in contagem.items():
+                self._usos[tipo].setdefault(id_, {})[nome] = n
+            por_tipo[tipo] = contagem
+            # Reservas gravadas agora já contam como uso
+            reservas = self._reservas[tipo]
+            for dono in [d for d, (_, id_, _) in reservas.items() if id_ in contagem]:
+                del reservas[dono]
+        self._por_aba[nome] = por_tipo
+
+    def existe(self, tipo, id_):
+        with self._lock:
+            return str(id_).strip() in self._usos[tipo]
+
+    def gerar_lote(self, tipo, prefixos):
+        """
+        Um ID livre para cada prefixo, sem repetir IDs dentro do lote.
+        """
+        with self._lock:
+            return self._gerar_lote(tipo, prefixos)
+
+    def _gerar_lote(self, tipo, prefixos):
+        usos = self._usos[tipo]
+        reservados = {id_ for _, id_, _ in self._reservas[tipo].values()}
+        proximos = {}
+        novos = []
+        for prefixo in prefixos:
+            numero = proximos.get(prefixo, self.NUMERO_INICIAL)
+            while f"{prefixo}{numero}" in usos or f"{prefixo}{numero}" in reservados:
+                numero += 1
+            novos.append(f"{prefixo}{numero}")
+            proximos[prefixo] = numero + 1
+        return novos
+
+    def gerar(self, tipo, prefixo):
+        return self.gerar_lote(tipo, [prefixo])[0]
+
+    def reservar(self, tipo, prefixo, dono):
+        """
+        ID para o prefixo reservado para dono (uma sessão), que deixa de ser
+        oferecido às demais. Enquanto não for gravado, o dono recebe o mesmo ID
+        para o mesmo prefixo (e a reserva é renovada); outro prefixo troca a
+        reserva do dono por um ID novo.
+        """
+        with self._lock:
+            agora = time.time()
+            reservas = self._reservas[tipo]
+            for outro in [d for d, (_, _, instante) in reservas.items() if agora - instante > self.RESERVA_SEGUNDOS]:
+                del reservas[outro]
+            atual = reservas.pop(dono, None)
+            if atual is not None and atual[0] == prefixo and atual[1] not in self._usos[tipo]:
+                id_ = atual[1]
+            else:
+                id_ = self._gerar_lote(tipo, [prefixo])[0]
+            reservas[dono] = (prefixo, id_, agora)
+            return id_
+
+    def duplicados(self):
+        """
+        IDs usados mais de uma vez: ID de fornecedor em mais de uma aba ou ID
+        de produto em mais de uma linha.
+        """
+        linhas = []
+        with self._lock:
+            for tipo, usos in self._usos.items():
+                for id_, abas in usos.items():
+                    ocorrencias = sum(abas.values())
+                    if ocorrencias > 1:
+                        linhas.append({
+                            "Tipo": self.COLUNAS[tipo],
+                            "ID": id_,
+                            "Ocorrências": ocorrencias,
+                            "Abas (Fornecedor)": ", ".join(sorted(abas)),
+                        })
+        colunas = ["Tipo", "ID", "Ocorrências", "Abas (Fornecedor)"]
+        return pd.DataFrame(linhas, columns=colunas).sort_values(["Tipo", "ID"], ignore_index=True)
+
+@st.cache_resource
+def get_registro_ids():
+    return RegistroIds()
+
+def registro_ids():
+    """
+    Registro de IDs do processo. É montado na primeira geração/consulta de ID,
+    a partir das abas salvas (lê todas), e depois atualizado a cada save.
+    """
+    registro = get_registro_ids()
+    if not registro.montado:
+        registro.montar(load_fornecedores())
+    return registro
+
+def reservar_id(tipo, prefixo):
+    """
+    ID reservado para a sessão (RegistroIds.reservar): os reruns do formulário
+    não consomem números e a sessão segura um só ID por tipo.
+    """
+    dono = st.session_state.setdefault("dono_reservas_ids", uuid.uuid4().hex)
+    return registro_ids().reservar(tipo, prefixo, dono)
+
+def marcar_fornecedor_alterado(nome):
+    """
+    Registra que a aba do fornecedor foi criada/alterada e precisa ser salva.
+    """
+    st.session_state.fornecedores_alterados.add(nome)
+    st.session_state.fornecedores_excluidos.discard(nome)
+    atualizar_catalogo(nome)
+    st.session_state.get("indice_produtos", {}).pop(nome, None)
+
+def marcar_fornecedor_excluido(nome):
+    st.session_state.fornecedores_alterados.discard(nome)
+    st.session_state.fornecedores_excluidos.add(nome)
+    atualizar_catalogo(nome)
+    st.session_state.get("indice_produtos", {}).pop(nome, None)
+
+def _preparar_fornecedor_para_salvar(df):
+    if "CNPJ" in df.columns:
+        df["CNPJ"] = df["CNPJ"].astype(str)
+    if "Contato" in df.columns:
+        df["Contato"] = df["Contato"].astype(str)
+    if "Inicio do contrato" in df.columns:
+        df["Inicio do contrato"] = datetime_to_str_series(df["Inicio do contrato"])
+    if "Termino do contrato" in df.columns:
+        df["Termino do contrato"] = datetime_to_str_series(df["Termino do contrato"])
+    if "Início do Pagamento" in df.columns:
+        df["Início do Pagamento"] = datetime_to_str_series(df["Início do Pagamento"])
+    return df
+
 def save_fornecedores():
+    """
+    Salva só as abas de fornecedores marcadas como alteradas/excluídas; as
+    demais abas do arquivo ficam como estão.
+    """
+    alterados = st.session_state.fornecedores_alterados
+    excluidos = st.session_state.fornecedores_excluidos
+    if not alterados and not excluidos:
+        st.info("Nenhuma alteração pendente nos fornecedores.")
+        return
     try:
-        with st.spinner("Salvando dados de fornecedores..."):
-            for sheet_name, df in st.session_state.suppliers_data.items():
-                if "CNPJ" in df.columns:
-                    df["CNPJ"] = df["CNPJ"].astype(str)
-                if "Contato" in df.columns:
-                    df["Contato"] = df["Contato"].astype(str)
-                if "Inicio do contrato" in df.columns:
-                    df["Inicio do contrato"] = df["Inicio do contrato"].apply(_datetime_to_str)
-                if "Termino do contrato" in df.columns:
-                    df["Termino do contrato"] = df["Termino do contrato"].apply(_datetime_to_str)
-                if "Início do Pagamento" in df.columns:
-                    df["Início do Pagamento"] = df["Início do Pagamento"].apply(_datetime_to_str)
-
-            output = BytesIO()
-            with pd.ExcelWriter(output) as writer:
-                for sheet_name, df_to_write in st.session_state.suppliers_data.items():
-                    # Replace NaN with blank
-                    df_to_write = df_to_write.fillna("")
-                    df_to_write.to_excel(writer, sheet_name=sheet_name, index=False)
-
-            ctx = ClientContext(SITE_URL).with_credentials(UserCredential(EMAIL_REMETENTE, SENHA_EMAIL))
-            File.save_binary(ctx, FILE_URL_FORNECEDORES, output.getvalue())
-
-        st.success("Dados de Fornecedores salvos com sucesso! Para visualizar, atualize a página ou acesse a aba 'Lista de Fornecedores'.")
+        suppliers_data = st.session_state.suppliers_data
+        # Snapshots copy-on-write: a preparação não altera as abas da sessão
+        alteracoes = {nome: suppliers_data[nome].copy(deep=False) for nome in alterados if nome in suppliers_data}
+        for sheet_name in excluidos:
+            alteracoes[sheet_name] = None
+
+        trabalho = get_journal().enfileirar(
+            FILE_URL_FORNECEDORES, alteracoes,
+            preparar=lambda df: _preparar_fornecedor_para_salvar(df).fillna("")
+        )
+        st.session_state.trabalhos_salvamento.append(trabalho)
+        alterados.clear()
+        excluidos.clear()
+        # Novas sessões passam a ver as abas salvas, sem reler as demais
+        planilha = get_cache_compartilhado().get("fornecedores")
+        if planilha is not None:
+            planilha.aplicar(alteracoes)
+        registro = get_registro_ids()
+        for nome, df in alteracoes.items():
+            registro.atualizar(nome, df)
+
+        st.success(f"Dados de Fornecedores salvos com sucesso! O envio ao SharePoint é feito em segundo plano (trabalho #{trabalho}).")
         st.info("Por favor, recarregue a página após concluir as alterações para garantir que todos os dados estejam atualizados.")
     except Exception as e:
-        if "Locked" in str(e) or "423" in str(e):
-            st.warning("Arquivo de Fornecedores bloqueado. Feche ou faça check-in antes de salvar.")
-        else:
-            st.error(f"Erro ao salvar Fornecedores: {e}")
+        st.error(f"Erro ao salvar Fornecedores: {e}")
 
 ###############################################################################
 # 6) CÓDIGO PARA CONTROLE MENSAL
 ###############################################################################
-def load_controle_mensal():
+def tipar_controle_mensal(df):
+    """
+    Aplica ESQUEMA_CONTROLE_MENSAL. Colunas ausentes viram NA do tipo da coluna,
+    textos vazios viram NA e Dia Vencimento fica como texto se houver valores
+    que não são dias. Colunas já no tipo certo não são convertidas de novo.
+    """
+    df = df.copy(deep=False)
+    for col, tipo in ESQUEMA_CONTROLE_MENSAL.items():
+        if col not in df.columns:
+            df[col] = pd.Series(pd.NA, index=df.index, dtype=object)
+        serie = df[col]
+        if serie.dtype == object:
+            serie = serie.mask(serie.isin([""]))
+
+        if isinstance(tipo, pd.CategoricalDtype):
+            # Categorias fixas (Mes); note que CategoricalDtype == "category" é True
+            if serie.dtype != tipo:
+                serie = serie.astype(tipo)
+        elif tipo == "category":
+            if not isinstance(serie.dtype, pd.CategoricalDtype):
+                serie = serie.astype("category")
+            novas = pd.Index(CATEGORIAS_CONTROLE_MENSAL.get(col, [])).difference(serie.cat.categories)
+            if len(novas):
+                serie = serie.cat.add_categories(novas)
+        elif col == "Dia Vencimento":
+            if serie.dtype not in ("Int8", "string"):
+                dias = pd.to_numeric(serie, errors="coerce")
+                validos = dias.dropna()
+                if len(validos) == serie.notna().sum() and validos.between(1, 31).all() and (validos % 1 == 0).all():
+                    serie = dias.astype("Int8")
+                else:
+                    serie = serie.astype("string")
+        elif tipo == "float64":
+            if serie.dtype != "float64":
+                if serie.dtype == object:
+                    serie = parse_float_br_series(serie)
+                serie = pd.to_numeric(serie, errors="coerce").astype("float64")
+        elif tipo == "datetime64[ns]":
+            if serie.dtype != tipo:
+                serie = pd.to_datetime(serie, errors="coerce", dayfirst=True)
+        elif tipo == "Int16":
+            if serie.dtype != tipo:
+                serie = pd.to_numeric(serie, errors="coerce").astype(tipo)
+        elif serie.dtype != tipo:
+            serie = serie.astype(tipo)
+        df[col] = serie
+    return df
+
+def concat_controle_mensal(partes, ignore_index=False):
+    """
+    pd.concat que preserva o esquema: as categorias das partes são unidas antes,
+    senão o pandas devolveria object nas colunas categóricas.
+    """
+    partes = [tipar_controle_mensal(p) for p in partes if p is not None]
+    for col, tipo in ESQUEMA_CONTROLE_MENSAL.items():
+        if isinstance(tipo, pd.CategoricalDtype) or tipo != "category":
+            continue
+        categorias = pd.Index([])
+        for p in partes:
+            categorias = categorias.append(p[col].cat.categories.difference(categorias))
+        for i, p in enumerate(partes):
+            if not p[col].cat.categories.equals(categorias):
+                partes[i] = p.assign(**{col: p[col].cat.set_categories(categorias)})
+    return tipar_controle_mensal(pd.concat(partes, ignore_index=ignore_index))
+
+def _normalizar_mes(ano, mes, df_mes):
+    df_mes.columns = df_mes.columns.astype(str).str.strip()
+    if "Data Envio" in df_mes.columns:
+        df_mes["Data Envio"] = pd.to_datetime(df_mes["Data Envio"], errors="coerce", dayfirst=True)
+    if "Data Pagamento" in df_mes.columns:
+        df_mes["Data Pagamento"] = pd.to_datetime(df_mes["Data Pagamento"], errors="coerce", dayfirst=True)
+    if "Valor Estimado - Real" in df_mes.columns:
+        df_mes["Valor Estimado - Real"] = pd.to_numeric(parse_float_br_series(df_mes["Valor Estimado - Real"]), errors="coerce")
+    if "Valor Pago Convertido" in df_mes.columns:
+        df_mes["Valor Pago Convertido"] = pd.to_numeric(parse_float_br_series(df_mes["Valor Pago Convertido"]), errors="coerce")
+
+    df_mes["Ano"] = ano
+    df_mes["Mes"] = mes
+    return tipar_controle_mensal(df_mes)
+
+def _normalizar_controle_ano(ano, sheets):
+    """
+    Padroniza as abas de mês de um arquivo anual; ignora 'MATRIZ' e demais abas.
     """
-    Lê os arquivos (2025, 2026), ignora 'MATRIZ' e abas fora de MESES_ORDENADOS.
-    Concatena num único DataFrame.
+    meses = {}
+    for sheet_name, df_mes in sheets.items():
+        sn = sheet_name.strip().upper()
+        if sn == "MATRIZ":
+            continue
+        if sn not in MESES_ORDENADOS:
+            continue
+        meses[sheet_name] = _normalizar_mes(ano, sn, df_mes)
+    return meses
+
+def _nomes_colunas(cabecalho):
     """
+    Nomes das colunas como o pandas daria: vazio vira "Unnamed: i" e nomes
+    repetidos ganham ".1", ".2"...
+    """
+    nomes = []
+    vistos = {}
+    for i, valor in enumerate(cabecalho):
+        nome = f"Unnamed: {i}" if valor is None or valor == "" else str(valor)
+        if nome in vistos:
+            vistos[nome] += 1
+            nome = f"{nome}.{vistos[nome]}"
+        vistos.setdefault(nome, 0)
+        nomes.append(nome)
+    return nomes
+
+# Textos que o read_excel lê como NaN (na_values padrão do pandas) e os
+# códigos de erro do Excel, que ele também devolve como NaN
+VALORES_NA_EXCEL = frozenset([
+    "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]) | frozenset(openpyxl.cell.cell.ERROR_CODES)
+
+def _linha_xlsx(linha):
+    """
+    Valores de uma linha como o read_excel os vê: sem as células vazias do fim,
+    10.0 como 10 (IDs numéricos viram "10") e NA/erros como None.
+    """
+    fim = len(linha)
+    while fim and (linha[fim - 1] is None or linha[fim - 1] == ""):
+        fim -= 1
+    valores = []
+    for valor in linha[:fim]:
+        if type(valor) is float and valor.is_integer():
+            valor = int(valor)
+        elif valor == "" or (type(valor) is str and valor in VALORES_NA_EXCEL):
+            valor = None
+        valores.append(valor)
+    return valores
+
+def _coluna_xlsx(valores):
+    """
+    Coluna com a inferência do read_excel: só números/vazios (ou textos
+    numéricos) vira número; o resto fica object com NaN nos vazios.
+    """
+    serie = pd.Series(valores, dtype=object)
+    if serie.empty:
+        return serie
     try:
-        dfs = []
-        map_ano_arquivo = {
-            "2025": FILE_URL_MENSAL_2025,
-            "2026": FILE_URL_MENSAL_2026,
-        }
-        for ano, url_arq in map_ano_arquivo.items():
+        return pd.to_numeric(serie)
+    except (ValueError, TypeError):
+        return serie.where(serie.notna(), np.nan)
+
+def ler_controle_ano_xlsx(ano, conteudo):
+    """
+    Lê as abas de mês de um arquivo anual em streaming (openpyxl read_only +
+    iter_rows), sem montar o workbook inteiro nem um DataFrame por aba:
+    MATRIZ e as demais abas que não são de mês nem são abertas, e cada aba vira
+    colunas tipadas assim que termina de ser lida, liberando as listas dela.
+    Segue as regras do read_excel: linhas e colunas vazias no meio do intervalo
+    ficam (NaN / "Unnamed: i"), só as do fim são descartadas; NA e erros do
+    Excel viram NaN; colunas só numéricas viram número. O resultado é o mesmo
+    de _normalizar_controle_ano(ano, pd.read_excel(...)).
+    """
+    wb = openpyxl.load_workbook(BytesIO(conteudo), read_only=True, data_only=True)
+    try:
+        meses = {}
+        for ws in wb.worksheets:
+            sn = ws.title.strip().upper()
+            if sn not in MESES_ORDENADOS:
+                continue
+            linhas = ws.iter_rows(values_only=True)
+            cabecalho = _linha_xlsx(next(linhas, ()))
+            colunas = [[] for _ in cabecalho]
+            n_linhas = 0
+            em_branco = 0
+            for linha in linhas:
+                valores = _linha_xlsx(linha)
+                # Linhas em branco só entram se vier outra linha com dados depois
+                if not valores:
+                    em_branco += 1
+                    continue
+                for coluna in colunas:
+                    coluna.extend([None] * em_branco)
+                n_linhas += em_branco
+                em_branco = 0
+                if len(valores) > len(colunas):
+                    colunas.extend([None] * n_linhas for _ in range(len(valores) - len(colunas)))
+                for i, coluna in enumerate(colunas):
+                    coluna.append(valores[i] if i < len(valores) else None)
+                n_linhas += 1
+            cabecalho += [None] * (len(colunas) - len(cabecalho))
+            nomes = _nomes_colunas(cabecalho)
+            df_mes = pd.DataFrame(
+                {nome: _coluna_xlsx(coluna) for nome, coluna in zip(nomes, colunas)},
+                index=pd.RangeIndex(n_linhas),
+                # Um bloco por coluna: cada coluna convertida libera a original
+                copy=False,
+            )
+            del colunas
+            meses[ws.title] = _normalizar_mes(ano, sn, df_mes)
+        return meses
+    finally:
+        wb.close()
+
+def _ler_controle_ano(ano, url_arq, storage, journal=None):
+    """
+    Lê o arquivo de um ano e devolve a lista de DataFrames das abas de mês.
+    Roda em thread: erros sobem para quem coleta o resultado.
+    """
+    meses = load_normalizado(
+        url_arq, storage, lambda sheets: _normalizar_controle_ano(ano, sheets), journal,
+        ler_xlsx=lambda conteudo: ler_controle_ano_xlsx(ano, conteudo),
+    )
+    return list(meses.values())
+
+def descobrir_arquivos_anuais(storage):
+    """
+    {ano: url} dos arquivos de controle mensal encontrados em PASTA_CONTROLE_MENSAL
+    pelo padrão do nome. Se a pasta não puder ser listada (ou não tiver nenhum
+    arquivo no padrão), usa ARQUIVOS_MENSAIS_PADRAO.
+    """
+    try:
+        arquivos = storage.list_files(PASTA_CONTROLE_MENSAL)
+    except Exception:
+        return dict(ARQUIVOS_MENSAIS_PADRAO)
+    encontrados = {}
+    for url_arq in sorted(arquivos):
+        m = PADRAO_ARQUIVO_MENSAL.match(posixpath.basename(url_arq))
+        if m:
+            encontrados[m.group(1)] = url_arq
+    return dict(sorted(encontrados.items())) or dict(ARQUIVOS_MENSAIS_PADRAO)
+
+def mapa_ano_arquivo():
+    """
+    {ano (texto): url do arquivo} dos anos disponíveis. A listagem da pasta fica
+    no cache compartilhado (TTL), então um arquivo de ano novo aparece sozinho.
+    """
+    cache = get_cache_compartilhado()
+    with cache.carregando("arquivos_anuais"):
+        mapa = cache.get("arquivos_anuais")
+        if mapa is None:
+            mapa = descobrir_arquivos_anuais(get_storage())
+            cache.set("arquivos_anuais", mapa)
+    return mapa
+
+def _chave_ano(ano):
+    return f"controle_mensal:{ano}"
+
+def controle_mensal_vazio():
+    return tipar_controle_mensal(pd.DataFrame(columns=COLUNAS_CONTROLE_MENSAL))
+
+def _coletar_ano(ano, url_arq, futuro):
+    """
+    DataFrame de um ano (Janeiro a Dezembro) a partir do future da leitura, ou
+    None se falhou - o erro vira aviso e o ano será tentado de novo depois.
+    """
+    try:
+        meses = futuro.result()
+    except Exception as e:
+        st.warning(f"Erro ao carregar {url_arq} ({ano}): {e}")
+        return None
+    if not meses:
+        return controle_mensal_vazio()
+    # Mes é categórico ordenado: ordena de Janeiro a Dezembro
+    return concat_controle_mensal(meses, ignore_index=True).sort_values(by="Mes", kind="stable")
+
+def carregar_anos(anos):
+    """
+    {ano: DataFrame} dos anos pedidos que têm arquivo. Cada ano fica no cache
+    compartilhado com chave própria; os que faltam são lidos em paralelo e os
+    anos com erro ficam de fora.
+    """
+    mapa = mapa_ano_arquivo()
+    anos = sorted({str(ano) for ano in anos} & set(mapa))
+    cache = get_cache_compartilhado()
+    with ExitStack() as locks:
+        # Locks sempre na mesma ordem (anos ordenados) para não travar sessões
+        for ano in anos:
+            locks.enter_context(cache.carregando(_chave_ano(ano)))
+        resultado = {ano: cache.get(_chave_ano(ano)) for ano in anos}
+        faltando = [ano for ano, df in resultado.items() if df is None]
+        if faltando:
+            storage = get_storage()
+            journal = get_journal()
+            with ThreadPoolExecutor(max_workers=len(faltando)) as pool:
+                futuros = {
+                    ano: pool.submit(_ler_controle_ano, ano, mapa[ano], storage, journal)
+                    for ano in faltando
+                }
+            for ano, futuro in futuros.items():
+                resultado[ano] = _coletar_ano(ano, mapa[ano], futuro)
+                if resultado[ano] is not None:
+                    cache.set(_chave_ano(ano), resultado[ano])
+    return {ano: df for ano, df in resultado.items() if df is not None}
+
+def anos_iniciais():
+    """
+    Anos carregados ao abrir a aplicação: só o ano corrente (ou, se ele ainda não
+    tem arquivo, o mais recente). Os demais são carregados quando consultados.
+    """
+    mapa = mapa_ano_arquivo()
+    ano_atual = str(datetime.date.today().year)
+    if ano_atual in mapa:
+        return [ano_atual]
+    return [max(mapa)] if mapa else []
+
+def load_dados_iniciais(anos):
+    """
+    Carrega Fornecedores e os anos pedidos do Controle Mensal de uma vez: os
+    arquivos são baixados e lidos em paralelo, e o tempo de abertura fica
+    próximo ao do arquivo mais lento. Erros são reportados na thread do script.
+    O que já estiver no cache compartilhado (e dentro do TTL) não é relido.
+    Retorna (fornecedores da sessão, {ano: DataFrame}).
+    """
+    cache = get_cache_compartilhado()
+    with cache.carregando("fornecedores"):
+        planilha = cache.get("fornecedores")
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            futuro_forn = None
+            if planilha is None:
+                futuro_forn = pool.submit(_ler_fornecedores, get_storage(), get_journal())
+            # Os anos são lidos nesta thread enquanto Fornecedores baixa na outra
+            controle_por_ano = carregar_anos(anos)
+        if futuro_forn is not None:
             try:
-                sheets = load_excel_from_sharepoint(url_arq)
-                for sheet_name, df_mes in sheets.items():
-                    sn = sheet_name.strip().upper()
-                    if sn == "MATRIZ":
-                        continue
-                    if sn not in MESES_ORDENADOS:
-                        continue
-                    df_mes.columns = df_mes.columns.str.strip()
-                    for col in COLUNAS_CONTROLE_MENSAL:
-                        if col not in df_mes.columns:
-                            df_mes[col] = ""
-                    if "Data Envio" in df_mes.columns:
-                        df_mes["Data Envio"] = pd.to_datetime(df_mes["Data Envio"], errors="coerce", dayfirst=True)
-                    if "Data Pagamento" in df_mes.columns:
-                        df_mes["Data Pagamento"] = pd.to_datetime(df_mes["Data Pagamento"], errors="coerce", dayfirst=True)
-                    if "Valor Estimado - Real" in df_mes.columns:
-                        df_mes["Valor Estimado - Real"] = df_mes["Valor Estimado - Real"].astype(str).apply(parse_float_br)
-                    if "Valor Pago Convertido" in df_mes.columns:
-                        df_mes["Valor Pago Convertido"] = df_mes["Valor Pago Convertido"].astype(str).apply(parse_float_br)
-
-                    df_mes["Ano"] = ano
-                    df_mes["Mes"] = sn
-                    dfs.append(df_mes)
+                planilha = futuro_forn.result()
+                cache.set("fornecedores", planilha)
             except Exception as e:
-                st.warning(f"Erro ao carregar {url_arq} ({ano}): {e}")
+                st.error(f"Erro ao carregar Fornecedores: {e}")
+                return {}, controle_por_ano
+    return FornecedoresSessao(planilha), controle_por_ano
 
-        if len(dfs) == 0:
-            return pd.DataFrame(columns=COLUNAS_CONTROLE_MENSAL)
-        df_final = pd.concat(dfs, ignore_index=True)
-        df_final["Mes_Indice"] = df_final["Mes"].apply(lambda x: MESES_ORDENADOS.index(x) if x in MESES_ORDENADOS else 99)
-        df_final = df_final.sort_values(by=["Ano", "Mes_Indice"]).drop(columns=["Mes_Indice"])
-        return df_final
+def adicionar_anos_na_sessao(controle_por_ano):
+    """
+    Junta anos recém-carregados a st.session_state["controle_mensal"]. As linhas
+    novas recebem rótulos após os existentes e o índice é refeito sob demanda.
+    """
+    if not controle_por_ano:
+        return
+    ledger = st.session_state["controle_mensal"]
+    inicio = int(ledger.index.max()) + 1 if len(ledger) else 0
+    novos = []
+    for ano in sorted(controle_por_ano):
+        df_ano = snapshot_controle_mensal(controle_por_ano[ano])
+        novos.append(df_ano.set_axis(pd.RangeIndex(inicio, inicio + len(df_ano))))
+        inicio += len(df_ano)
+    partes = [ledger] + novos if len(ledger) else novos
+    ledger = concat_controle_mensal(partes).sort_values(by=["Ano", "Mes"], kind="stable")
+    st.session_state["controle_mensal"] = ledger
+    st.session_state.anos_carregados.update(controle_por_ano)
+    st.session_state.pop("indice_pagamentos", None)
+    atualizar_agregados(adicionadas=concat_controle_mensal(novos))
+
+def garantir_anos_carregados(anos):
+    """
+    Carrega na sessão os anos pedidos que ainda não foram carregados. Anos sem
+    arquivo são ignorados; anos com erro são tentados de novo na próxima vez.
+    """
+    faltando = {str(ano) for ano in anos} - st.session_state.anos_carregados
+    if faltando:
+        adicionar_anos_na_sessao(carregar_anos(faltando))
 
-    except Exception as e:
-        st.error(f"Erro ao carregar controle mensal: {e}")
-        return pd.DataFrame(columns=COLUNAS_CONTROLE_MENSAL)
+class IndicePagamentos:
+    """
+    Índice (ID - Pagamento, Ano, Mes) -> rótulos de linha do controle mensal.
+    Os rótulos são estáveis: linhas novas recebem o próximo rótulo livre em vez
+    de renumerar o DataFrame, então o índice só muda onde houve alteração.
+    """
+    COLUNAS = ["ID - Pagamento", "Ano", "Mes"]
+
+    def __init__(self, df):
+        self._linhas = {}
+        self._chave_da_linha = {}
+        self._proximo = 0
+        if df.empty:
+            return
+        chaves = df[self.COLUNAS].astype(str)
+        for chave, posicoes in chaves.groupby(self.COLUNAS, sort=False).indices.items():
+            rotulos = df.index[posicoes].tolist()
+            self._linhas[chave] = rotulos
+            for rotulo in rotulos:
+                self._chave_da_linha[rotulo] = chave
+        self._proximo = int(df.index.max()) + 1
+
+    @staticmethod
+    def _chave(id_pag, ano, mes):
+        return (str(id_pag), str(ano), str(mes))
+
+    def linhas(self, id_pag, ano, mes):
+        return list(self._linhas.get(self._chave(id_pag, ano, mes), ()))
+
+    def proximo_rotulo(self):
+        rotulo = self._proximo
+        self._proximo += 1
+        return rotulo
+
+    def adicionar(self, rotulo, id_pag, ano, mes):
+        self.remover([rotulo])
+        chave = self._chave(id_pag, ano, mes)
+        self._linhas.setdefault(chave, []).append(rotulo)
+        self._chave_da_linha[rotulo] = chave
+        if isinstance(rotulo, (int, np.integer)):
+            self._proximo = max(self._proximo, int(rotulo) + 1)
+
+    def remover(self, rotulos):
+        for rotulo in rotulos:
+            chave = self._chave_da_linha.pop(rotulo, None)
+            if chave is None:
+                continue
+            restantes = self._linhas[chave]
+            restantes.remove(rotulo)
+            if not restantes:
+                del self._linhas[chave]
+
+def indice_pagamentos():
+    """
+    Índice da sessão sobre st.session_state["controle_mensal"]; quem altera
+    linhas do controle atualiza o índice junto.
+    """
+    if "indice_pagamentos" not in st.session_state:
+        st.session_state.indice_pagamentos = IndicePagamentos(st.session_state["controle_mensal"])
+    return st.session_state.indice_pagamentos
+
+def marcar_mes_alterado(ano, mes):
+    """
+    Registra que a partição (Ano, Mes) do controle mensal mudou e precisa ser salva.
+    O ano é guardado como texto, igual às chaves de mapa_ano_arquivo().
+    """
+    st.session_state.controle_alterado.add((str(ano), mes))
+
+def _preparar_mes_para_salvar(df_mes):
+    for col in COLUNAS_CONTROLE_MENSAL:
+        if col not in df_mes.columns:
+            df_mes[col] = ""
+    if "Data Envio" in df_mes.columns:
+        df_mes["Data Envio"] = datetime_to_str_series(df_mes["Data Envio"])
+    if "Data Pagamento" in df_mes.columns:
+        df_mes["Data Pagamento"] = datetime_to_str_series(df_mes["Data Pagamento"])
+    # Categorias e tipos anuláveis não aceitam "" - volta para object antes
+    df_mes = df_mes.astype(object)
+    return df_mes.where(df_mes.notna(), "")
 
 def save_controle_mensal():
     """
     Salva st.session_state["controle_mensal"] particionado por (Ano, Mes).
+    Só as abas de mês alteradas são reescritas, e só nos arquivos dos anos
+    afetados; MATRIZ e as demais abas do arquivo ficam intactas.
     """
-    df = st.session_state["controle_mensal"].copy()
-    if df.empty:
-        st.warning("Não há pagamentos para salvar.")
+    alterados = st.session_state.controle_alterado
+    if not alterados:
+        st.info("Nenhuma alteração pendente nos pagamentos.")
         return
 
-    with st.spinner("Salvando registros de pagamentos..."):
-        group = df.groupby(["Ano", "Mes"], as_index=False)
-        dict_ano_mes = {}
-        for (ano, mes), df_subset in group:
-            for col in COLUNAS_CONTROLE_MENSAL:
-                if col not in df_subset.columns:
-                    df_subset[col] = ""
-            if "Data Envio" in df_subset.columns:
-                df_subset["Data Envio"] = df_subset["Data Envio"].apply(_datetime_to_str)
-            if "Data Pagamento" in df_subset.columns:
-                df_subset["Data Pagamento"] = df_subset["Data Pagamento"].apply(_datetime_to_str)
-            if ano not in dict_ano_mes:
-                dict_ano_mes[ano] = {}
-            dict_ano_mes[ano][mes] = df_subset
-
-        map_ano_arquivo = {
-            "2025": FILE_URL_MENSAL_2025,
-            "2026": FILE_URL_MENSAL_2026,
+    df = st.session_state["controle_mensal"]
+    meses_por_ano = {}
+    for ano, mes in alterados:
+        meses_por_ano.setdefault(ano, set()).add(mes)
+
+    journal = get_journal()
+    cache = get_cache_compartilhado()
+    mapa = mapa_ano_arquivo()
+    for ano, meses in meses_por_ano.items():
+        if ano not in mapa:
+            st.warning(f"Ano {ano} não mapeado. Ignorando.")
+            continue
+
+        df_ano = df[(df["Ano"] == int(ano)).fillna(False)]
+        # Garante a ordem de Janeiro a Dezembro nas abas novas; a formatação
+        # para o Excel é feita ao gravar no diário
+        alteracoes = {
+            mes: df_ano[df_ano["Mes"] == mes]
+            for mes in MESES_ORDENADOS
+            if mes in meses
         }
 
-        for ano, meses_dict in dict_ano_mes.items():
-            if ano not in map_ano_arquivo:
-                st.warning(f"Ano {ano} não mapeado. Ignorando.")
-                continue
+        try:
+            trabalho = journal.enfileirar(mapa[ano], alteracoes, preparar=_preparar_mes_para_salvar)
+            st.session_state.trabalhos_salvamento.append(trabalho)
+            alterados.difference_update((ano, mes) for mes in meses)
+            # Novas sessões passam a ler os meses salvos deste ano
+            atualizar_meses_em_cache(ano, df_ano, meses)
+            st.success(f"Os pagamentos referentes a {ano} foram salvos com sucesso! O envio ao SharePoint é feito em segundo plano (trabalho #{trabalho}).")
+            st.info("Por favor, recarregue a página depois de salvar para ver os dados atualizados.")
+        except Exception as e:
+            st.error(f"Erro ao salvar pagamentos de {ano}: {e}")
+            cache.invalidate(_chave_ano(ano))
+
+def atualizar_meses_em_cache(ano, df_ano, meses):
+    """
+    Troca no ano em cache (compartilhado) só as linhas dos meses salvos; os
+    demais meses ficam como estão, inclusive os salvos por outras sessões. Sem
+    o ano em cache não há o que fazer: a próxima carga lê arquivo + diário.
+    """
+    cache = get_cache_compartilhado()
+    chave = _chave_ano(ano)
+    with cache.carregando(chave):
+        atual = cache.get(chave)
+        if atual is None:
+            return
+        novo = concat_controle_mensal(
+            [atual[~atual["Mes"].isin(meses)], df_ano[df_ano["Mes"].isin(meses)]], ignore_index=True
+        )
+        cache.set(chave, snapshot_controle_mensal(novo.sort_values("Mes", kind="stable", ignore_index=True)))
 
-            output = BytesIO()
-            with pd.ExcelWriter(output) as writer:
-                # Garante a ordem de Janeiro a Dezembro nas abas
-                for mes in MESES_ORDENADOS:
-                    if mes in meses_dict:
-                        df_abames = meses_dict[mes].fillna("")
-                        df_abames.to_excel(writer, sheet_name=mes, index=False)
+def mudancas_do_editor(df_original, df_editado, estado):
+    """
+    Conjunto de mudanças de um st.data_editor a partir do estado do widget
+    (deleted_rows/edited_rows/added_rows, em posições de df_original). Os valores
+    editados vêm de df_editado, que já está nos tipos das colunas; as linhas
+    inseridas são montadas de added_rows, porque o editor só as anexa a
+    df_editado quando o índice é um RangeIndex ou quando o usuário digita um
+    valor de índice.
+    Retorna (rótulos removidos, valores editados, máscara das células editadas,
+    linhas inseridas).
+    """
+    removidas = df_original.index[[int(p) for p in estado.get("deleted_rows", [])]]
+    editadas = {df_original.index[int(p)]: celulas for p, celulas in estado.get("edited_rows", {}).items()}
+    editadas = {rotulo: celulas for rotulo, celulas in editadas.items() if rotulo not in removidas}
+
+    mascara = pd.DataFrame(False, index=pd.Index(list(editadas)), columns=df_editado.columns)
+    for rotulo, celulas in editadas.items():
+        mascara.loc[rotulo, [c for c in celulas if c in mascara.columns]] = True
+    valores = df_editado.loc[mascara.index, mascara.columns]
+
+    inseridas = pd.DataFrame(list(estado.get("added_rows", [])), columns=df_original.columns, dtype=object)
+    for col in inseridas.columns:
+        tipo = df_original[col].dtype
+        if pd.api.types.is_datetime64_any_dtype(tipo):
+            inseridas[col] = pd.to_datetime(inseridas[col], errors="coerce")
+        elif pd.api.types.is_numeric_dtype(tipo):
+            inseridas[col] = pd.to_numeric(inseridas[col], errors="coerce").astype(tipo if pd.api.types.is_float_dtype(tipo) else "float64")
+        else:
+            inseridas[col] = inseridas[col].where(inseridas[col].notna(), pd.NA)
+    return removidas, valores, mascara, inseridas
 
-            try:
-                ctx = ClientContext(SITE_URL).with_credentials(UserCredential(EMAIL_REMETENTE, SENHA_EMAIL))
-                File.save_binary(ctx, map_ano_arquivo[ano], output.getvalue())
-                st.success(f"Os pagamentos referentes a {ano} foram salvos com sucesso no Excel do SharePoint!")
-                st.info("Por favor, recarregue a página depois de salvar para ver os dados atualizados.")
-            except Exception as e:
-                if "Locked" in str(e) or "423" in str(e):
-                    st.warning("Arquivo de Pagamentos bloqueado. Feche ou faça check-in antes de salvar.")
-                else:
-                    st.error(f"Erro ao salvar pagamentos de {ano}: {e}")
+def aplicar_mudancas_lancamentos(removidas, valores, mascara, inseridas, ano, mes):
+    """
+    Aplica o conjunto de mudanças no controle da sessão: remove as linhas,
+    atribui as células editadas uma coluna por vez, recalcula a Diferença das
+    linhas alteradas e anexa as inseridas com Ano/Mes da tela. Mantém o índice
+    de pagamentos e os agregados em dia. Retorna quantas linhas inseridas foram
+    ignoradas por não terem Fornecedor ou ID - Pagamento.
+    """
+    indice = indice_pagamentos()
+    original = st.session_state["controle_mensal"]
+    alteradas = mascara.index[mascara.any(axis=1)]
+    ledger = original.drop(removidas)
+
+    def _atribuir(rotulos, col, novos):
+        if isinstance(ledger[col].dtype, pd.CategoricalDtype):
+            faltando = pd.Index(novos.dropna().unique()).difference(ledger[col].cat.categories)
+            if len(faltando):
+                ledger[col] = ledger[col].cat.add_categories(faltando)
+        elif pd.api.types.is_datetime64_any_dtype(ledger[col]):
+            novos = pd.to_datetime(novos, errors="coerce")
+        else:
+            novos = novos.astype(ledger[col].dtype)
+        ledger.loc[rotulos, col] = novos
+
+    for col in mascara.columns[mascara.any()]:
+        rotulos = mascara.index[mascara[col]]
+        _atribuir(rotulos, col, valores.loc[rotulos, col])
+
+    # Quem trocou de fornecedor passa a ter o ID - Fornecedor do novo fornecedor
+    if "Fornecedor" in mascara.columns and mascara["Fornecedor"].any():
+        trocadas = mascara.index[mascara["Fornecedor"]]
+        fornecedores = ledger.loc[trocadas, "Fornecedor"].astype(object)
+        _atribuir(trocadas, "ID - Fornecedor", fornecedores.map(
+            ids_por_fornecedor(st.session_state.suppliers_data, fornecedores.dropna())
+        ))
+
+    if len(alteradas):
+        ledger.loc[alteradas, "Diferença"] = (
+            ledger.loc[alteradas, "Valor Estimado - Real"] - ledger.loc[alteradas, "Valor Pago Convertido"]
+        )
+
+    novas = inseridas[inseridas["Fornecedor"].notna() & inseridas["ID - Pagamento"].fillna("").astype(str).str.strip().ne("")]
+    ignoradas = len(inseridas) - len(novas)
+    if not novas.empty:
+        novas = novas.copy()
+        novas["ID - Fornecedor"] = novas["Fornecedor"].astype(object).map(
+            ids_por_fornecedor(st.session_state.suppliers_data, novas["Fornecedor"].astype(object))
+        )
+        for col, padrao in PADROES_PAGAMENTO.items():
+            novas[col] = novas[col].astype(object).fillna(padrao) if col in novas.columns else padrao
+        for col in ("Valor Estimado - Real", "Valor Pago Convertido"):
+            novas[col] = novas[col].fillna(0.0)
+        novas["Diferença"] = novas["Valor Estimado - Real"] - novas["Valor Pago Convertido"]
+        novas["Ano"] = ano
+        novas["Mes"] = mes
+        novas = novas.set_axis([indice.proximo_rotulo() for _ in range(len(novas))])
+        ledger = concat_controle_mensal([ledger, novas])
+
+    st.session_state["controle_mensal"] = ledger
+    atualizar_agregados(
+        removidas=original.loc[original.index.intersection(alteradas.union(removidas))],
+        adicionadas=ledger.loc[alteradas.union(novas.index)],
+    )
+    indice.remover(removidas)
+    if "ID - Pagamento" in mascara.columns:
+        for rotulo in mascara.index[mascara["ID - Pagamento"]]:
+            indice.adicionar(rotulo, ledger.at[rotulo, "ID - Pagamento"], ano, mes)
+    for rotulo, id_pag in zip(novas.index, novas["ID - Pagamento"]):
+        indice.adicionar(rotulo, id_pag, ano, mes)
+    return ignoradas
+
+###############################################################################
+# 6.1) IMPORTAÇÃO EM LOTE DE PAGAMENTOS
+###############################################################################
+COLUNAS_OBRIGATORIAS_IMPORTACAO = ["Fornecedor", "ID - Pagamento", "Ano", "Mes"]
+
+def ler_arquivo_importacao(nome_arquivo, conteudo):
+    """
+    Lê o CSV (separador detectado) ou a primeira aba do XLSX enviado.
+    """
+    if nome_arquivo.lower().endswith(".csv"):
+        try:
+            return pd.read_csv(BytesIO(conteudo), sep=None, engine="python", dtype=str, encoding="utf-8-sig")
+        except UnicodeDecodeError:
+            return pd.read_csv(BytesIO(conteudo), sep=None, engine="python", dtype=str, encoding="latin-1")
+    return pd.read_excel(BytesIO(conteudo))
+
+def validar_importacao(df_import, fornecedores):
+    """
+    Normaliza o arquivo importado para o esquema do controle mensal.
+    Retorna (linhas válidas tipadas, linhas com erro + coluna "Erro").
+    """
+    df = df_import.copy()
+    df.columns = df.columns.astype(str).str.strip()
+    faltando = [c for c in COLUNAS_OBRIGATORIAS_IMPORTACAO if c not in df.columns]
+    if faltando:
+        raise ValueError(f"Colunas obrigatórias ausentes: {', '.join(faltando)}")
+
+    for col in ("Fornecedor", "ID - Pagamento", "Mes"):
+        df[col] = df[col].astype("string").str.strip().replace("", pd.NA)
+    df["Mes"] = df["Mes"].str.upper()
+    for col, padrao in PADROES_PAGAMENTO.items():
+        if col not in df.columns:
+            df[col] = padrao
+        df[col] = df[col].mask(df[col].isna() | df[col].isin([""]), padrao)
+
+    # ID - Fornecedor vem da aba do fornecedor quando não informado
+    if "ID - Fornecedor" not in df.columns:
+        df["ID - Fornecedor"] = pd.NA
+    df["ID - Fornecedor"] = df["ID - Fornecedor"].fillna(df["Fornecedor"].map(ids_por_fornecedor(fornecedores, df["Fornecedor"].dropna())))
+
+    preenchidas = {
+        col: df[col].notna() & df[col].astype("string").str.strip().ne("").fillna(False)
+        for col in ("Data Envio", "Data Pagamento", "Valor Estimado - Real", "Valor Pago Convertido")
+        if col in df.columns
+    }
+    ano = pd.to_numeric(df["Ano"], errors="coerce")
+    df["Ano"] = ano.where(ano % 1 == 0)
+    # Dia inválido não pode rebaixar a coluna inteira para texto
+    dia_invalido = pd.Series(False, index=df.index)
+    if "Dia Vencimento" in df.columns:
+        dias = pd.to_numeric(df["Dia Vencimento"], errors="coerce")
+        dia_preenchido = df["Dia Vencimento"].notna() & df["Dia Vencimento"].astype("string").str.strip().ne("").fillna(False)
+        dia_invalido = dia_preenchido & ~(dias.between(1, 31) & (dias % 1 == 0))
+        df["Dia Vencimento"] = dias.where(~dia_invalido)
+    tipado = tipar_controle_mensal(df)
+
+    erros = pd.Series("", index=df.index, dtype=object)
+    def _erro(mascara, mensagem):
+        nonlocal erros
+        erros = erros.mask(mascara.fillna(True).astype(bool), erros + mensagem + "; ")
+
+    _erro(df["Fornecedor"].isna(), "Fornecedor vazio")
+    _erro(df["Fornecedor"].notna() & ~df["Fornecedor"].isin(list(fornecedores)), "Fornecedor não cadastrado")
+    _erro(df["ID - Pagamento"].isna(), "ID - Pagamento vazio")
+    _erro(~ano.astype(str).str.removesuffix(".0").isin(list(mapa_ano_arquivo())), "Ano sem arquivo de controle")
+    _erro(~df["Mes"].isin(MESES_ORDENADOS), "Mês inválido")
+    _erro(dia_invalido, "Dia Vencimento inválido")
+    for col, preenchida in preenchidas.items():
+        _erro(preenchida & tipado[col].isna(), f"{col} inválido")
+
+    # Valores vazios contam como zero, como no formulário
+    for col in ("Valor Estimado - Real", "Valor Pago Convertido"):
+        tipado[col] = tipado[col].fillna(0.0)
+    tipado["Diferença"] = tipado["Valor Estimado - Real"] - tipado["Valor Pago Convertido"]
+
+    ok = erros.eq("")
+    invalidas = df_import.loc[~ok].assign(Erro=erros[~ok].str.rstrip("; "))
+    return tipado.loc[ok, COLUNAS_CONTROLE_MENSAL], invalidas
+
+def planejar_importacao(ledger, indice, validas, somar):
+    """
+    Calcula a importação sem alterar nada (dry-run).
+    "Criar Novo Pagamento" anexa todas as linhas; "Somar com Existente" agrega o
+    lote por (ID - Pagamento, Ano, Mes) e, se a chave já existe no controle,
+    mantém o valor estimado original e soma o valor pago, como no formulário.
+    Retorna (rótulos a remover, linhas novas, prévia das mudanças).
+    """
+    chave = IndicePagamentos.COLUNAS
+    remover = []
+    if not somar:
+        novas = validas
+        pago_antes = pd.Series(np.nan, index=novas.index)
+    else:
+        outras = [c for c in COLUNAS_CONTROLE_MENSAL if c not in chave]
+        novas = (
+            validas.groupby(chave, sort=False, observed=True, dropna=False)
+            .agg({**{c: "first" for c in outras}, "Valor Pago Convertido": "sum"})
+            .reset_index()[COLUNAS_CONTROLE_MENSAL]
+        )
+        novas = tipar_controle_mensal(novas)
+        rotulos = [indice.linhas(*k) for k in zip(novas["ID - Pagamento"], novas["Ano"], novas["Mes"])]
+        remover = [r for grupo in rotulos for r in grupo]
+        existentes = ledger.loc[remover, ["Valor Estimado - Real", "Valor Pago Convertido"]]
+        existentes["_grupo"] = np.repeat(np.arange(len(novas)), [len(g) for g in rotulos])
+        resumo = existentes.groupby("_grupo").agg(
+            estimado=("Valor Estimado - Real", "first"),
+            pago=("Valor Pago Convertido", "sum"),
+        ).reindex(np.arange(len(novas)))
+        resumo.index = novas.index
+        existe = resumo["pago"].notna() | resumo["estimado"].notna()
+        pago_antes = resumo["pago"].where(existe)
+        novas["Valor Estimado - Real"] = resumo["estimado"].where(existe, novas["Valor Estimado - Real"])
+        novas["Valor Pago Convertido"] = novas["Valor Pago Convertido"] + pago_antes.fillna(0.0)
+        novas["Diferença"] = novas["Valor Estimado - Real"] - novas["Valor Pago Convertido"]
+
+    previa = novas[["Fornecedor", "ID - Pagamento", "Ano", "Mes"]].copy()
+    previa.insert(0, "Ação", np.where(pago_antes.notna(), "Somar", "Inserir"))
+    previa["Valor Pago (antes)"] = pago_antes
+    previa["Valor Pago (depois)"] = novas["Valor Pago Convertido"]
+    previa["Valor Estimado - Real"] = novas["Valor Estimado - Real"]
+    previa["Diferença"] = novas["Diferença"]
+    return remover, novas, previa
+
+def aplicar_importacao(remover, novas):
+    """
+    Aplica o plano de planejar_importacao no controle da sessão e salva uma vez
+    (save_controle_mensal grava um arquivo por ano afetado).
+    """
+    indice = indice_pagamentos()
+    novas = novas.set_axis([indice.proximo_rotulo() for _ in range(len(novas))])
+    original = st.session_state["controle_mensal"]
+    ledger = concat_controle_mensal([original.drop(remover), novas])
+    st.session_state["controle_mensal"] = ledger
+    atualizar_agregados(removidas=original.loc[remover], adicionadas=ledger.loc[novas.index])
+    indice.remover(remover)
+    for rotulo, id_pag, ano, mes in zip(novas.index, novas["ID - Pagamento"], novas["Ano"], novas["Mes"]):
+        indice.adicionar(rotulo, id_pag, ano, mes)
+    for ano, mes in set(zip(novas["Ano"], novas["Mes"])):
+        marcar_mes_alterado(ano, mes)
+    save_controle_mensal()
+
+###############################################################################
+# 6.2) BENCHMARKS E RELATÓRIOS DE DESEMPENHO
+###############################################################################
+def _medir(funcao, repeticoes=3):
+    """
+    Menor tempo (s) entre algumas execuções de funcao().
+    """
+    melhor = None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        duracao = time.perf_counter() - inicio
+        melhor = duracao if melhor is None else min(melhor, duracao)
+    return melhor
+
+def benchmark_conversores(n_linhas=100_000):
+    """
+    Compara os conversores por célula (.apply) com os vetorizados em colunas
+    sintéticas no formato das planilhas. Confere também que os resultados batem.
+    """
+    rng = random.Random(42)
+    # Textos de borda, que os dois conversores têm de aceitar/recusar igual
+    bordas = ["1_000", "R$ 1_000,50", "١٢٣", "１２,５", "abc", "R$ -1.000,00", "-1e3", "+inf", "nan", " 7 "]
+    valores = [
+        rng.choice([f"R$ {rng.randint(0, 99999):,}.{rng.randint(0, 99):02d}", f"{rng.random() * 1000:.2f}", "", None])
+        for _ in range(n_linhas - len(bordas))
+    ]
+    valores = [v.replace(",", "_").replace(".", ",").replace("_", ".") if isinstance(v, str) else v for v in valores]
+    valores += bordas
+    datas = [
+        rng.choice([
+            pd.Timestamp(2020, 1, 1) + pd.Timedelta(days=rng.randint(0, 3000)),
+            f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2025",
+            None,
+        ])
+        for _ in range(n_linhas)
+    ]
+    serie_valores = pd.Series(valores, dtype=object)
+    serie_datas = pd.Series(datas, dtype=object)
+    serie_datetime64 = pd.to_datetime(serie_datas.where(serie_datas.map(type).ne(str)))
+    serie_textos = serie_datas.map(_datetime_to_str)
+
+    casos = [
+        ("parse_float_br (R$ em texto)", lambda: serie_valores.apply(parse_float_br), lambda: parse_float_br_series(serie_valores)),
+        ("_datetime_to_str (datas + texto, leitura)", lambda: serie_datas.apply(_datetime_to_str), lambda: datetime_to_str_series(serie_datas)),
+        ("_datetime_to_str (datetime64, controle mensal)", lambda: serie_datetime64.apply(_datetime_to_str), lambda: datetime_to_str_series(serie_datetime64)),
+        ("_datetime_to_str (já formatado, save)", lambda: serie_textos.apply(_datetime_to_str), lambda: datetime_to_str_series(serie_textos)),
+    ]
+    linhas = []
+    for nome, por_celula, vetorizado in casos:
+        esperado = pd.Series(por_celula(), dtype=object)
+        obtido = pd.Series(vetorizado(), dtype=object)
+        iguais = bool(((esperado == obtido) | (esperado.isna() & obtido.isna())).all())
+        t_celula = _medir(por_celula)
+        t_vetor = _medir(vetorizado)
+        linhas.append({
+            "Conversor": nome,
+            "Linhas": n_linhas,
+            "Por célula (s)": round(t_celula, 4),
+            "Vetorizado (s)": round(t_vetor, 4),
+            "Ganho (x)": round(t_celula / t_vetor, 1) if t_vetor else None,
+            "Resultados iguais": iguais,
+        })
+    return pd.DataFrame(linhas)
+
+def _medir_pico(funcao):
+    """
+    (resultado, tempo em s, pico de memória alocada em MB) de funcao(), pelo tracemalloc.
+    """
+    tracemalloc.start()
+    try:
+        inicio = time.perf_counter()
+        resultado = funcao()
+        duracao = time.perf_counter() - inicio
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return resultado, duracao, pico / 1024 / 1024
+
+def benchmark_leitura_controle(ano, conteudo):
+    """
+    Pico de memória e tempo para ler um arquivo anual: read_excel de todas as
+    abas + normalização contra a leitura em streaming (ler_controle_ano_xlsx).
+    Confere também que os DataFrames resultantes batem.
+    """
+    casos = [
+        ("read_excel (todas as abas)", lambda: _normalizar_controle_ano(ano, pd.read_excel(BytesIO(conteudo), sheet_name=None))),
+        ("Streaming (só abas de mês)", lambda: ler_controle_ano_xlsx(ano, conteudo)),
+    ]
+    linhas = []
+    resultados = []
+    for nome, funcao in casos:
+        meses, duracao, pico = _medir_pico(funcao)
+        resultados.append(meses)
+        final = sum(df.memory_usage(deep=True).sum() for df in meses.values()) / 1024 / 1024
+        linhas.append({
+            "Leitura": nome,
+            "Arquivo (MB)": round(len(conteudo) / 1024 / 1024, 2),
+            "Pico (MB)": round(pico, 2),
+            "Resultado (MB)": round(final, 2),
+            "Tempo (s)": round(duracao, 3),
+        })
+    esperado, obtido = resultados
+    iguais = list(esperado) == list(obtido) and all(
+        esperado[aba].reset_index(drop=True).equals(obtido[aba].reset_index(drop=True)) for aba in esperado
+    )
+    relatorio = pd.DataFrame(linhas)
+    relatorio["Resultados iguais"] = iguais
+    return relatorio
+
+def relatorio_memoria_controle(df):
+    """
+    Memória por coluna do controle mensal tipado contra a representação antiga
+    (textos em object com "" no lugar de vazio; Ano como texto).
+    """
+    linhas = []
+    for col in df.columns:
+        serie = df[col]
+        if pd.api.types.is_float_dtype(serie) or pd.api.types.is_datetime64_any_dtype(serie):
+            antiga = serie
+        else:
+            antiga = serie.astype(object).where(serie.notna(), "")
+            if col == "Ano":
+                antiga = antiga.astype(str)
+        antes = antiga.memory_usage(deep=True, index=False)
+        agora = serie.memory_usage(deep=True, index=False)
+        linhas.append({"Coluna": col, "Tipo": str(serie.dtype), "Antes (KB)": antes / 1024, "Agora (KB)": agora / 1024})
+    relatorio = pd.DataFrame(linhas)
+    total = {"Coluna": "TOTAL", "Tipo": "", "Antes (KB)": relatorio["Antes (KB)"].sum(), "Agora (KB)": relatorio["Agora (KB)"].sum()}
+    relatorio = pd.concat([relatorio, pd.DataFrame([total])], ignore_index=True)
+    relatorio["Economia (%)"] = (1 - relatorio["Agora (KB)"] / relatorio["Antes (KB)"].where(relatorio["Antes (KB)"] > 0)) * 100
+    return relatorio.round(1)
+
+###############################################################################
+# 6.3) AGREGADOS DE GASTOS (PAINEL)
+###############################################################################
+class AgregadosGastos:
+    """
+    Totais do controle mensal por Ano, Mes, Categoria, Fornecedor e Planejado:
+    estimado, pago, diferença e quantidade de lançamentos. É montado uma vez;
+    depois cada mudança no controle soma as linhas novas e subtrai as antigas,
+    sem varrer o controle inteiro. O painel consulta só esta tabela.
+    """
+    CHAVES = ["Ano", "Mes", "Categoria", "Fornecedor", "Planejado"]
+    MEDIDAS = {
+        "Valor Estimado - Real": "Estimado",
+        "Valor Pago Convertido": "Pago",
+        "Diferença": "Diferença",
+    }
+
+    def __init__(self, df):
+        self.tabela = self._somar(df)
+
+    @classmethod
+    def _somar(cls, df):
+        colunas = list(cls.MEDIDAS.values()) + ["Lançamentos"]
+        if df is None or df.empty:
+            return pd.DataFrame(columns=colunas, index=pd.MultiIndex.from_tuples([], names=cls.CHAVES), dtype="float64")
+        # Chaves vazias viram "" para que as somas e subtrações alinhem pelo índice
+        chaves = {col: df[col].astype(object).where(df[col].notna(), "") for col in cls.CHAVES}
+        chaves["Ano"] = chaves["Ano"].map(str)
+        medidas = pd.DataFrame({nome: df[col].fillna(0.0) for col, nome in cls.MEDIDAS.items()})
+        medidas["Lançamentos"] = 1.0
+        return medidas.groupby([chaves[col] for col in cls.CHAVES], sort=False).sum()
+
+    def atualizar(self, removidas=None, adicionadas=None):
+        """
+        Subtrai as linhas removidas (na versão antiga) e soma as adicionadas
+        (na versão nova); uma edição é as duas coisas.
+        """
+        tabela = self.tabela.add(self._somar(adicionadas), fill_value=0.0)
+        tabela = tabela.sub(self._somar(removidas), fill_value=0.0)
+        self.tabela = tabela[tabela["Lançamentos"] > 0]
+
+    def do_ano(self, ano):
+        tabela = self.tabela
+        return tabela[tabela.index.get_level_values("Ano") == str(ano)]
+
+def agregados_gastos():
+    """
+    Agregados da sessão sobre st.session_state["controle_mensal"]; quem altera
+    linhas do controle chama atualizar_agregados com as linhas antes e depois.
+    """
+    if "agregados_gastos" not in st.session_state:
+        st.session_state.agregados_gastos = AgregadosGastos(st.session_state["controle_mensal"])
+    return st.session_state.agregados_gastos
+
+def atualizar_agregados(removidas=None, adicionadas=None):
+    agregados = st.session_state.get("agregados_gastos")
+    if agregados is not None:
+        agregados.atualizar(removidas, adicionadas)
+
+def resumo_gastos(tabela, por):
+    """
+    Totais da tabela de agregados somados pelo(s) nível(is) em por.
+    """
+    if tabela.empty:
+        return pd.DataFrame(columns=tabela.columns)
+    return tabela.groupby(level=por, sort=False).sum()
+
+def resumo_mensal(tabela):
+    """
+    Totais por mês, de Janeiro a Dezembro (meses sem lançamento zerados).
+    """
+    return resumo_gastos(tabela, "Mes").reindex(MESES_ORDENADOS, fill_value=0.0)
+
+def grafico_mensal(resumo_mes):
+    """
+    Barras de estimado x pago por mês (resumo_mensal).
+    """
+    posicoes = np.arange(len(resumo_mes))
+    fig, ax = plt.subplots(figsize=(9, 3.5))
+    ax.bar(posicoes - 0.2, resumo_mes["Estimado"], width=0.4, label="Estimado")
+    ax.bar(posicoes + 0.2, resumo_mes["Pago"], width=0.4, label="Pago")
+    ax.set_xticks(posicoes)
+    ax.set_xticklabels([mes[:3] for mes in resumo_mes.index])
+    ax.set_ylabel("R$")
+    ax.legend()
+    fig.tight_layout()
+    return fig
+
+def hash_dados(df):
+    """
+    Versão dos dados de um gráfico: muda só se valores, índice ou colunas mudarem.
+    """
+    h = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    h.update(repr(list(df.columns)).encode("utf-8"))
+    return h.hexdigest()
+
+class CacheGraficos:
+    """
+    Gráficos já renderizados (PNG), chaveados por (especificação do gráfico,
+    versão dos dados), com descarte do menos usado (LRU). Como os reruns do
+    Streamlit acontecem a cada interação, a figura só é desenhada de novo
+    quando os dados dela mudam; nos demais casos os bytes vão direto para a tela.
+    """
+
+    def __init__(self, capacidade):
+        self.capacidade = capacidade
+        self._lock = threading.Lock()
+        self._itens = OrderedDict()
+        self.acertos = 0
+        self.renderizacoes = 0
+
+    def obter(self, especificacao, dados, desenhar):
+        """
+        PNG de desenhar(dados) para a especificação, do cache ou renderizado agora.
+        """
+        chave = (especificacao, hash_dados(dados))
+        with self._lock:
+            png = self._itens.get(chave)
+            if png is not None:
+                self._itens.move_to_end(chave)
+                self.acertos += 1
+                return png
+        fig = desenhar(dados)
+        try:
+            buffer = BytesIO()
+            fig.savefig(buffer, format="png", dpi=100)
+            png = buffer.getvalue()
+        finally:
+            plt.close(fig)
+        with self._lock:
+            self._itens[chave] = png
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.capacidade:
+                self._itens.popitem(last=False)
+            self.renderizacoes += 1
+        return png
+
+    def __len__(self):
+        return len(self._itens)
+
+
+@st.cache_resource
+def get_cache_graficos():
+    return CacheGraficos(CACHE_GRAFICOS_MAX)
+
+###############################################################################
+# 6.4) PROJEÇÃO DOS CONTRATOS (PROJETADO X REALIZADO)
+###############################################################################
+# Status de contrato que não gera mais pagamentos
+STATUS_CONTRATO_INATIVO = ["INATIVO", "CANCELADO", "ENCERRADO"]
+# Formas de pagamento de parcela única
+FORMAS_PAGAMENTO_UNICO = ["A VISTA", "À VISTA"]
+
+def _datas_br(serie):
+    return pd.to_datetime(serie.astype(object).where(serie.notna(), ""), format="%d/%m/%Y", errors="coerce")
+
+def _indice_mes(datas):
+    """
+    Data -> número do mês (ano * 12 + mês - 1); NaT vira NaN.
+    """
+    return (datas.dt.year * 12 + datas.dt.month - 1).astype("float64")
+
+def projetar_contratos(catalogo, ano_inicio, mes_inicio, n_meses):
+    """
+    Pagamentos mensais esperados dos contratos ativos do catálogo de
+    fornecedores, nos n_meses a partir de (ano_inicio, mes_inicio: 1-12).
+    Cada contrato vira um intervalo de meses - do Início do Pagamento (ou do
+    contrato) até a última parcela (Tempo de pagamento), o Término do contrato
+    ou o fim do horizonte, o que vier antes - e os intervalos são expandidos
+    numa passada só (np.repeat), sem laço por contrato. Sem Valor mensal, usa
+    Valor do plano / parcelas. Dia de Pagamento vira Dia Vencimento. Forma de
+    pagamento à vista é uma parcela só, no mês de início, seja qual for o
+    Tempo de pagamento.
+    """
+    colunas = ["Fornecedor", "ID - Fornecedor", "ID - Pagamento", "Categoria", "Dia Vencimento", "Ano", "Mes", "Valor Projetado"]
+    if catalogo.empty:
+        return pd.DataFrame(columns=colunas)
+    h_ini = ano_inicio * 12 + mes_inicio - 1
+    h_fim = h_ini + n_meses - 1
+
+    inicio = _indice_mes(_datas_br(catalogo["Início do Pagamento"]).fillna(_datas_br(catalogo["Inicio do contrato"])))
+    termino = _indice_mes(_datas_br(catalogo["Termino do contrato"]))
+    parcelas = pd.to_numeric(catalogo["Tempo de pagamento"], errors="coerce")
+    parcelas = parcelas.where(parcelas > 0)
+    forma = catalogo["Forma de pagamento"].astype(object).fillna("").astype(str).str.strip().str.upper()
+    parcelas = parcelas.mask(forma.isin(FORMAS_PAGAMENTO_UNICO), 1)
+    valor = pd.to_numeric(catalogo["Valor mensal"], errors="coerce")
+    valor = valor.fillna(pd.to_numeric(catalogo["Valor do plano"], errors="coerce") / parcelas)
+    dia = pd.to_numeric(catalogo["Dia de Pagamento"], errors="coerce")
+    dia = dia.where(dia.between(1, 31) & (dia % 1 == 0))
+    status = catalogo["Status"].astype(object).fillna("").astype(str).str.strip().str.upper()
+
+    fim = np.fmin(np.fmin((inicio + parcelas - 1).to_numpy(), termino.to_numpy()), h_fim)
+    ini = np.fmax(inicio.to_numpy(), h_ini)
+    quantidade = np.nan_to_num(fim - ini + 1, nan=0.0).clip(min=0).astype(np.int64)
+    validos = (~status.isin(STATUS_CONTRATO_INATIVO) & inicio.notna() & valor.notna() & valor.ne(0)).to_numpy()
+    quantidade[~validos] = 0
+
+    # Linha de cada parcela e deslocamento dela dentro do intervalo do contrato
+    linhas = np.repeat(np.arange(len(catalogo)), quantidade)
+    deslocamento = np.arange(len(linhas)) - np.repeat(np.cumsum(quantidade) - quantidade, quantidade)
+    mes_absoluto = ini[linhas].astype(np.int64) + deslocamento
+
+    def _texto(col):
+        return catalogo[col].astype(object).where(catalogo[col].notna(), "").astype(str).str.strip().to_numpy()[linhas]
+
+    id_pag = _texto("ID - Pagamento")
+    id_pag = np.where(id_pag == "", _texto("ID - Produto"), id_pag)
+    projecao = pd.DataFrame({
+        "Fornecedor": _texto("Aba (Fornecedor)"),
+        "ID - Fornecedor": _texto("ID - Fornecedor"),
+        "ID - Pagamento": id_pag,
+        "Categoria": _texto("Categoria do Produto"),
+        "Dia Vencimento": dia.to_numpy()[linhas],
+        "Ano": mes_absoluto // 12,
+        "Mes": pd.Categorical.from_codes(mes_absoluto % 12, dtype=ESQUEMA_CONTROLE_MENSAL["Mes"]),
+        "Valor Projetado": valor.to_numpy()[linhas],
+    })
+    return projecao[colunas]
+
+def projetado_x_realizado(projecao, ledger, ano):
+    """
+    Junta a projeção do ano com o controle mensal por (Fornecedor, ID -
+    Pagamento, Ano, Mes): Projetado, Estimado e Pago lado a lado, e Desvio =
+    Pago - Projetado. Linhas só de um lado ficam com zero no outro.
+    """
+    chaves = ["Fornecedor", "ID - Pagamento", "Ano", "Mes"]
+    projecao = projecao[projecao["Ano"] == int(ano)]
+    ledger = ledger[(ledger["Ano"] == int(ano)).fillna(False)]
+
+    def _chaves(df):
+        return [df[col].astype(object).where(df[col].notna(), "").astype(str) for col in chaves]
+
+    projetado = projecao.groupby(_chaves(projecao), sort=False)["Valor Projetado"].sum().rename("Projetado")
+    realizado = ledger.groupby(_chaves(ledger), sort=False)[["Valor Estimado - Real", "Valor Pago Convertido"]].sum()
+    realizado.columns = ["Estimado", "Pago"]
+    comparacao = pd.concat([projetado, realizado], axis=1).fillna(0.0).reset_index()
+    comparacao["Desvio"] = comparacao["Pago"] - comparacao["Projetado"]
+    comparacao["Mes"] = pd.Categorical(comparacao["Mes"], dtype=ESQUEMA_CONTROLE_MENSAL["Mes"])
+    return comparacao.sort_values(["Mes", "Fornecedor", "ID - Pagamento"], kind="stable", ignore_index=True)
+
+def gerar_lancamentos_do_mes(projecao, indice, ano, mes):
+    """
+    Linhas PENDENTE do controle mensal para (ano, mes) a partir da projeção dos
+    contratos: o valor projetado (Valor mensal) vira Valor Estimado e o pago
+    fica zerado. IDs de pagamento que já têm lançamento no mês, ou que se
+    repetem na projeção, ficam de fora. Retorna linhas no formato de
+    planejar_importacao, prontas para aplicar_importacao.
+    """
+    do_mes = projecao[(projecao["Ano"] == int(ano)) & (projecao["Mes"] == mes)]
+    do_mes = do_mes[do_mes["ID - Pagamento"] != ""].drop_duplicates("ID - Pagamento")
+    ja_lancados = [bool(indice.linhas(id_pag, ano, mes)) for id_pag in do_mes["ID - Pagamento"]]
+    do_mes = do_mes[~np.array(ja_lancados, dtype=bool)]
+
+    novas = pd.DataFrame({
+        "Fornecedor": do_mes["Fornecedor"],
+        "ID - Fornecedor": do_mes["ID - Fornecedor"].replace("", pd.NA),
+        "ID - Pagamento": do_mes["ID - Pagamento"],
+        "Categoria": do_mes["Categoria"].replace("", pd.NA),
+        "Dia Vencimento": do_mes["Dia Vencimento"],
+        "Valor Estimado - Real": do_mes["Valor Projetado"],
+        "Valor Pago Convertido": 0.0,
+        "Diferença": do_mes["Valor Projetado"],
+        "Ano": int(ano),
+        "Mes": mes,
+    })
+    for col, padrao in PADROES_PAGAMENTO.items():
+        novas[col] = padrao
+    return tipar_controle_mensal(novas.reset_index(drop=True))
+
+def grafico_projecao(resumo_mes):
+    """
+    Barras de projetado x pago por mês.
+    """
+    posicoes = np.arange(len(resumo_mes))
+    fig, ax = plt.subplots(figsize=(9, 3.5))
+    ax.bar(posicoes - 0.2, resumo_mes["Projetado"], width=0.4, label="Projetado (contratos)")
+    ax.bar(posicoes + 0.2, resumo_mes["Pago"], width=0.4, label="Pago")
+    ax.set_xticks(posicoes)
+    ax.set_xticklabels([mes[:3] for mes in resumo_mes.index])
+    ax.set_ylabel("R$")
+    ax.legend()
+    fig.tight_layout()
+    return fig
+
+###############################################################################
+# 6.5) CONCILIAÇÃO CATÁLOGO X CONTROLE MENSAL
+###############################################################################
+SITUACOES_CONCILIACAO = ["FALTANTE", "ÓRFÃO", "DUPLICADO", "VALOR DIVERGENTE"]
+
+def _texto_chave(serie):
+    """
+    Texto da chave sem espaços nas pontas (nulo vira ""); normaliza só os
+    valores distintos, que se repetem muito entre os meses.
+    """
+    codigos, unicos = pd.factorize(serie)
+    textos = pd.Series(np.asarray(unicos, dtype=object)).astype(str).str.strip().to_numpy()
+    return pd.Series(np.append(textos, "")[codigos], index=serie.index)
+
+def _codigos_mes(serie):
+    return pd.Categorical(serie, dtype=ESQUEMA_CONTROLE_MENSAL["Mes"]).codes.astype(np.int64)
+
+def conciliar(catalogo, ledger, anos, ate=None, tolerancia=0.01):
+    """
+    Confere o catálogo de fornecedores com o controle mensal dos anos dados,
+    por junções de hash na chave (Fornecedor, ID - Pagamento, Ano, Mes):
+    - FALTANTE: parcela esperada de contrato ativo (projetar_contratos) sem
+      lançamento no mês; só conta meses até `ate` (ano, mes 1-12; padrão: mês
+      atual);
+    - ÓRFÃO: lançamento cujo fornecedor/ID - Pagamento não está no catálogo;
+    - DUPLICADO: mais de um lançamento com a mesma chave;
+    - VALOR DIVERGENTE: Valor Estimado do mês difere do projetado (chaves
+      DUPLICADO ficam de fora: a soma dos lançamentos repetidos não é o valor
+      do mês).
+    A chave vira um inteiro só (fornecedor e ID fatorados juntos nos três
+    lados, mais o mês), e agrupamentos e junções correm sobre ele.
+    """
+    colunas = ["Situação", "Fornecedor", "ID - Pagamento", "Ano", "Mes", "Projetado", "Estimado", "Pago", "Lançamentos"]
+    anos = sorted(int(ano) for ano in anos)
+    if not anos:
+        return pd.DataFrame(columns=colunas)
+    if ate is None:
+        hoje = datetime.date.today()
+        ate = (hoje.year, hoje.month)
+    base = anos[0] * 12
+    n_meses = (anos[-1] - anos[0] + 1) * 12
+
+    ledger = ledger[(ledger["Ano"].isin(anos).fillna(False) & ledger["Mes"].notna()).to_numpy(dtype=bool)]
+    projecao = projetar_contratos(catalogo, anos[0], 1, n_meses)
+    mes_projecao = projecao["Ano"].to_numpy(dtype=np.int64) * 12 + _codigos_mes(projecao["Mes"])
+    projecao = projecao[
+        (projecao["Ano"].isin(anos) & (projecao["ID - Pagamento"] != "")).to_numpy(dtype=bool)
+        & (mes_projecao <= ate[0] * 12 + ate[1] - 1)
+    ]
+
+    # Pares fornecedor/ID do catálogo, com o mesmo fallback para ID - Produto da projeção
+    id_catalogo = _texto_chave(catalogo["ID - Pagamento"])
+    id_catalogo = id_catalogo.where(id_catalogo != "", _texto_chave(catalogo["ID - Produto"]))
+    fornecedores = [_texto_chave(ledger["Fornecedor"]), projecao["Fornecedor"], _texto_chave(catalogo["Aba (Fornecedor)"])]
+    ids = [_texto_chave(ledger["ID - Pagamento"]), projecao["ID - Pagamento"], id_catalogo]
+    codigos_forn, unicos_forn = pd.factorize(np.concatenate([serie.to_numpy(dtype=object) for serie in fornecedores]))
+    codigos_id, unicos_id = pd.factorize(np.concatenate([serie.to_numpy(dtype=object) for serie in ids]))
+    n_ids = max(len(unicos_id), 1)
+    pares = codigos_forn.astype(np.int64) * n_ids + codigos_id
+    n_ledger, n_projecao = len(ledger), len(projecao)
+    pares_catalogo = pares[n_ledger + n_projecao:]
+
+    chave_ledger = pares[:n_ledger] * n_meses + (
+        ledger["Ano"].to_numpy(dtype=np.int64) * 12 + _codigos_mes(ledger["Mes"]) - base
+    )
+    chave_projecao = pares[n_ledger:n_ledger + n_projecao] * n_meses + (
+        projecao["Ano"].to_numpy(dtype=np.int64) * 12 + _codigos_mes(projecao["Mes"]) - base
+    )
+    realizado = pd.DataFrame({
+        "Estimado": ledger["Valor Estimado - Real"].fillna(0.0).to_numpy(),
+        "Pago": ledger["Valor Pago Convertido"].fillna(0.0).to_numpy(),
+    }, index=chave_ledger).groupby(level=0).agg(
+        Estimado=("Estimado", "sum"), Pago=("Pago", "sum"), Lançamentos=("Estimado", "size")
+    )
+    esperado = pd.Series(projecao["Valor Projetado"].to_numpy(), index=chave_projecao).groupby(level=0).sum()
+    cruzado = pd.concat([esperado.rename("Projetado"), realizado], axis=1)
+
+    previsto = cruzado["Projetado"].notna()
+    lancado = cruzado["Lançamentos"].notna()
+    pares_cruzado = cruzado.index.to_numpy() // n_meses
+    id_vazio = unicos_id[pares_cruzado % n_ids] == ""
+    duplicado = lancado & (cruzado["Lançamentos"] > 1) & ~id_vazio
+    situacoes = {
+        "FALTANTE": previsto & ~lancado,
+        "ÓRFÃO": lancado & ~pd.Index(pares_cruzado).isin(pares_catalogo),
+        "DUPLICADO": duplicado,
+        "VALOR DIVERGENTE": previsto & lancado & ~duplicado
+        & ((cruzado["Estimado"] - cruzado["Projetado"]).abs() > tolerancia),
+    }
+    relatorio = pd.concat(
+        [cruzado[mascara].assign(**{"Situação": situacao}) for situacao, mascara in situacoes.items()]
+    )
+    chaves = relatorio.index.to_numpy()
+    pares_relatorio = chaves // n_meses
+    mes_absoluto = base + chaves % n_meses
+    relatorio = relatorio.reset_index(drop=True).assign(**{
+        "Fornecedor": unicos_forn[pares_relatorio // n_ids],
+        "ID - Pagamento": unicos_id[pares_relatorio % n_ids],
+        "Ano": mes_absoluto // 12,
+        "Mes": pd.Categorical.from_codes(mes_absoluto % 12, dtype=ESQUEMA_CONTROLE_MENSAL["Mes"]),
+        "Situação": pd.Categorical(relatorio["Situação"].to_numpy(), categories=SITUACOES_CONCILIACAO),
+        "Lançamentos": relatorio["Lançamentos"].fillna(0).astype("int64").to_numpy(),
+    })
+    return relatorio[colunas].sort_values(
+        ["Situação", "Ano", "Mes", "Fornecedor", "ID - Pagamento"], kind="stable", ignore_index=True
+    )
 
 ###############################################################################
 # 7) INICIALIZA ST.SESSION_STATE
 ###############################################################################
+# Controle mensal começa só com os anos iniciais; os demais entram sob demanda
+# (garantir_anos_carregados) e ficam na sessão depois de carregados
+controle_iniciais = None
+if "suppliers_data" not in st.session_state and "controle_mensal" not in st.session_state:
+    st.session_state.suppliers_data, controle_iniciais = load_dados_iniciais(anos_iniciais())
+
 if "suppliers_data" not in st.session_state:
     st.session_state.suppliers_data = load_fornecedores()
 
 if "controle_mensal" not in st.session_state:
-    st.session_state["controle_mensal"] = load_controle_mensal()
+    st.session_state["controle_mensal"] = controle_mensal_vazio()
+    st.session_state.anos_carregados = set()
+    if controle_iniciais is None:
+        controle_iniciais = carregar_anos(anos_iniciais())
+    adicionar_anos_na_sessao(controle_iniciais)
 
 if "fornecedor_criado" not in st.session_state:
     st.session_state.fornecedor_criado = False
 
+# Abas de fornecedores pendentes de salvar (só elas são reescritas no Excel)
+if "fornecedores_alterados" not in st.session_state:
+    st.session_state.fornecedores_alterados = set()
+if "fornecedores_excluidos" not in st.session_state:
+    st.session_state.fornecedores_excluidos = set()
+
+# Partições (Ano, Mes) do controle mensal pendentes de salvar
+if "controle_alterado" not in st.session_state:
+    st.session_state.controle_alterado = set()
+
+# Ids dos trabalhos de salvamento desta sessão (acompanhados na barra lateral)
+if "trabalhos_salvamento" not in st.session_state:
+    st.session_state.trabalhos_salvamento = []
+
 ###############################################################################
 # 8) CRIA AS ABAS NO STREAMLIT
 ###############################################################################
-tab_fornecedores, tab_lista, tab_registrar, tab_visualizar = st.tabs([
+tab_fornecedores, tab_lista, tab_registrar, tab_visualizar, tab_painel = st.tabs([
     "Gerenciar Fornecedores",
     "Lista de Fornecedores",
     "Registrar Pagamentos",
-    "Visualizar Lançamentos"
+    "Visualizar Lançamentos",
+    "Painel de Gastos"
 ])
 
 ###############################################################################
@@ -567,12 +3383,19 @@ with tab_fornecedores:
 
             if not new_supplier_name:
                 st.error("É preciso informar um nome para o fornecedor.")
-            elif new_supplier_name in suppliers:
+            elif any(nome.casefold() == new_supplier_name.casefold() for nome in suppliers):
                 st.error("Esse fornecedor já existe.")
+            elif validar_nome_aba(new_supplier_name):
+                st.error(f"Nome de fornecedor inválido. {validar_nome_aba(new_supplier_name)}")
+            elif new_id_fornecedor and registro_ids().existe("fornecedor", new_id_fornecedor):
+                st.error(f"O ID - Fornecedor {new_id_fornecedor} já está em uso.")
+            elif new_id_produto and registro_ids().existe("produto", new_id_produto):
+                st.error(f"O ID - Produto {new_id_produto} já está em uso.")
             else:
                 new_df = pd.DataFrame(columns=ALL_COLUMNS)
                 new_df.loc[len(new_df)] = new_row
                 st.session_state.suppliers_data[new_supplier_name] = new_df
+                marcar_fornecedor_alterado(new_supplier_name)
                 save_fornecedores()
                 st.session_state.fornecedor_criado = True
 
@@ -590,7 +3413,8 @@ with tab_fornecedores:
             else:
                 general_info = {col: "" for col in GENERAL_COLUMNS}
 
-            # Exibir campos gerais (editáveis)
+            # Exibir campos gerais (editáveis); o text_input devolve str(valor)
+            gerais_iniciais = {col: str(general_info[col]) for col in GENERAL_COLUMNS}
             for col in GENERAL_COLUMNS:
                 general_info[col] = st.text_input(col, value=general_info[col], key=f"{selected_supplier}_{col}")
 
@@ -599,9 +3423,9 @@ with tab_fornecedores:
             st.caption("Para inserir ou excluir linhas, use o '+' ou a lixeira no st.data_editor.")
 
             if "Inicio do contrato" in df_original.columns:
-                df_original["Inicio do contrato"] = df_original["Inicio do contrato"].apply(_datetime_to_str)
+                df_original["Inicio do contrato"] = datetime_to_str_series(df_original["Inicio do contrato"])
             if "Termino do contrato" in df_original.columns:
-                df_original["Termino do contrato"] = df_original["Termino do contrato"].apply(_datetime_to_str)
+                df_original["Termino do contrato"] = datetime_to_str_series(df_original["Termino do contrato"])
 
             # Fill NaNs para não aparecer "NaN" na tabela
             df_original = df_original.fillna("")
@@ -620,6 +3444,13 @@ with tab_fornecedores:
                     edited_df[col] = general_info[col]
 
             st.session_state.suppliers_data[selected_supplier] = edited_df
+            # Alterado só se algum campo geral mudou ou o editor registrou edições;
+            # comparar os DataFrames acusaria mudança só pela conversão para texto
+            estado_editor = st.session_state.get(f"editor_{selected_supplier}", {})
+            if any(general_info[col] != gerais_iniciais[col] for col in GENERAL_COLUMNS) or any(
+                estado_editor.get(chave) for chave in ("edited_rows", "added_rows", "deleted_rows")
+            ):
+                marcar_fornecedor_alterado(selected_supplier)
 
             # Botões de salvar e excluir fornecedor
             col1, col2 = st.columns(2)
@@ -629,6 +3460,7 @@ with tab_fornecedores:
             with col2:
                 if st.button("Excluir Fornecedor", key=f"excluir_{selected_supplier}"):
                     st.session_state.suppliers_data.pop(selected_supplier)
+                    marcar_fornecedor_excluido(selected_supplier)
                     save_fornecedores()
                     st.warning(f"Fornecedor '{selected_supplier}' excluído!")
                     st.stop()
@@ -746,6 +3578,7 @@ if selected_supplier and selected_supplier != "Adicionar Novo Fornecedor":
 
         df_updated = pd.concat([df_updated, pd.DataFrame([new_prod_row])], ignore_index=True)
         st.session_state.suppliers_data[selected_supplier] = df_updated
+        marcar_fornecedor_alterado(selected_supplier)
 
         # Salva e limpa
         save_fornecedores()
@@ -783,17 +3616,25 @@ with tab_lista:
         unsafe_allow_html=True
     )
 
-    suppliers = list(st.session_state.suppliers_data.keys())
-    if suppliers:
-        df_combined = pd.DataFrame()
-        for sup_name in suppliers:
-            df_temp = st.session_state.suppliers_data[sup_name].copy()
-            df_temp.insert(0, "Aba (Fornecedor)", sup_name)
-            df_combined = pd.concat([df_combined, df_temp], ignore_index=True)
-
-        # Replace NaN with blank before displaying
-        df_combined = df_combined.fillna("")
-        st.dataframe(df_combined)
+    fornecedores = st.session_state.suppliers_data
+    if fornecedores:
+        # A lista completa lê todas as abas: só é montada quando pedida (ou se
+        # todas já estiverem carregadas na sessão)
+        carregadas = getattr(fornecedores, "todas_carregadas", True)
+        if carregadas or "catalogo_fornecedores" in st.session_state or st.button("Carregar lista completa", key="carregar_catalogo"):
+            # Replace NaN with blank before displaying
+            st.dataframe(catalogo_fornecedores().fillna(""))
+        else:
+            st.caption(f"{len(fornecedores)} fornecedores; as abas são lidas sob demanda.")
+
+        with st.expander("IDs duplicados"):
+            if st.toggle("Verificar IDs duplicados", key="verificar_ids"):
+                duplicados = registro_ids().duplicados()
+                if duplicados.empty:
+                    st.success("Nenhum ID de fornecedor ou de produto duplicado.")
+                else:
+                    st.warning(f"{len(duplicados)} IDs usados mais de uma vez.")
+                    st.dataframe(duplicados, hide_index=True)
     else:
         st.info("Não há fornecedores cadastrados.")
 
@@ -804,7 +3645,7 @@ with tab_registrar:
     st.title("Registrar Pagamentos")
     st.write("Nesta seção, você pode adicionar novos pagamentos e salvá-los diretamente no Excel do SharePoint.")
 
-    df_mensal = st.session_state["controle_mensal"].copy()
+    df_mensal = st.session_state["controle_mensal"]
 
     # Selecionar Fornecedor
     fornecedores_list = list(st.session_state.suppliers_data.keys())
@@ -819,12 +3660,8 @@ with tab_registrar:
     st.text_input("ID - Fornecedor", value=id_fornecedor_label, disabled=True)
 
     # ID Pagamento
-    list_id_pag = []
-    if sel_fornecedor:
-        df_temp_forn = st.session_state.suppliers_data[sel_fornecedor]
-        if "ID - Pagamento" in df_temp_forn.columns:
-            vals = df_temp_forn["ID - Pagamento"].dropna().unique()
-            list_id_pag = sorted([v for v in vals if v])
+    produtos_forn = produtos_do_fornecedor(sel_fornecedor) if sel_fornecedor else {}
+    list_id_pag = sorted(produtos_forn)
 
     chosen_id_pag = st.selectbox("ID - Pagamento Existente", ["(Novo)"] + list_id_pag)
     if chosen_id_pag == "(Novo)":
@@ -832,9 +3669,8 @@ with tab_registrar:
         final_id_pag = typed_id_pag.strip()
     else:
         final_id_pag = chosen_id_pag
-        mask = df_temp_forn["ID - Pagamento"] == chosen_id_pag
-        if mask.any():
-            descricao_produto = df_temp_forn.loc[mask, "Descrição do Produto"].iloc[0]
+        if chosen_id_pag in produtos_forn:
+            descricao_produto = produtos_forn[chosen_id_pag]
             st.info(f"Descrição do Produto: {descricao_produto}")
         else:
             st.info("Nenhuma descrição encontrada para o ID selecionado.")
@@ -845,8 +3681,15 @@ with tab_registrar:
     hoje = datetime.date.today()
     ano_padrao = str(hoje.year)
     mes_padrao_index = (hoje.month - 1) if 1 <= hoje.month <= 12 else 0
-    sel_ano = st.text_input("Ano", ano_padrao)
+    # Normalizado uma vez: é o mesmo texto das chaves de mapa_ano_arquivo()
+    sel_ano = st.text_input("Ano", ano_padrao).strip()
+    if sel_ano.isdigit():
+        sel_ano = str(int(sel_ano))
     sel_mes = st.selectbox("Mês", MESES_ORDENADOS, index=mes_padrao_index)
+    # O ano informado passa a fazer parte do controle da sessão (se tiver arquivo)
+    if sel_ano.isdigit():
+        garantir_anos_carregados([sel_ano])
+        df_mensal = st.session_state["controle_mensal"]
 
     # Pré-carregamos, caso exista linha para esse ID no mesmo ano/mês
     default_dia_venc = ""
@@ -863,14 +3706,10 @@ with tab_registrar:
 
     df_existente = pd.DataFrame()
     if final_id_pag and final_id_pag != "" and chosen_id_pag != "(Novo)":
-        filtro_existente = (
-            (df_mensal["ID - Pagamento"] == final_id_pag)
-            & (df_mensal["Ano"] == sel_ano)
-            & (df_mensal["Mes"] == sel_mes)
-        )
-        df_existente = df_mensal[filtro_existente]
+        df_existente = df_mensal.loc[indice_pagamentos().linhas(final_id_pag, sel_ano, sel_mes)]
         if not df_existente.empty:
             registro_existente = df_existente.iloc[0]
+            registro_existente = registro_existente.where(registro_existente.notna(), "")
             default_dia_venc = registro_existente.get("Dia Vencimento", "")
             default_data_envio = _datetime_to_str(registro_existente.get("Data Envio", ""))
             default_data_pagamento = _datetime_to_str(registro_existente.get("Data Pagamento", ""))
@@ -925,6 +3764,8 @@ with tab_registrar:
         with st.spinner("Processando registro de pagamento..."):
             if not sel_fornecedor:
                 st.error("Selecione o fornecedor.")
+            elif not sel_ano.isdigit():
+                st.error("Informe o ano com números (ex.: 2025).")
             else:
                 try:
                     dt_env = parse_date_br(data_envio_str)
@@ -953,22 +3794,20 @@ with tab_registrar:
                         "Mes": sel_mes,
                     }
 
-                    filtro_salvar = (
-                        (df_mensal["ID - Pagamento"] == final_id_pag)
-                        & (df_mensal["Ano"] == sel_ano)
-                        & (df_mensal["Mes"] == sel_mes)
-                    )
-                    existe_linha = not df_mensal[filtro_salvar].empty
+                    indice = indice_pagamentos()
+                    rotulos_existentes = indice.linhas(final_id_pag, sel_ano, sel_mes)
+                    rotulos_removidos = []
 
-                    if existe_linha and merge_option == "Somar com Existente":
+                    if rotulos_existentes and merge_option == "Somar com Existente":
                         # Se for somar com existente, mantém valor estimado original e soma valor pago
-                        linhas_existentes = df_mensal[filtro_salvar]
+                        linhas_existentes = df_mensal.loc[rotulos_existentes]
                         valor_est_existente = linhas_existentes["Valor Estimado - Real"].iloc[0]
                         soma_val_pago = linhas_existentes["Valor Pago Convertido"].sum() + val_pag
                         nova_dif = valor_est_existente - soma_val_pago
 
                         # Remove linha(s) antiga(s)
-                        df_mensal = df_mensal[~filtro_salvar]
+                        df_mensal = df_mensal.drop(rotulos_existentes)
+                        rotulos_removidos = rotulos_existentes
 
                         # Atualiza new_row
                         new_row["Valor Estimado - Real"] = valor_est_existente
@@ -976,16 +3815,19 @@ with tab_registrar:
                         new_row["Diferença"] = nova_dif
                         new_row["Dia Vencimento"] = dia_vencimento
 
-                    new_line_df = pd.DataFrame([new_row])
-                    df_mensal = pd.concat([df_mensal, new_line_df], ignore_index=True)
-
-                    # Converter colunas de data
-                    if "Data Envio" in df_mensal.columns:
-                        df_mensal["Data Envio"] = pd.to_datetime(df_mensal["Data Envio"], errors="coerce")
-                    if "Data Pagamento" in df_mensal.columns:
-                        df_mensal["Data Pagamento"] = pd.to_datetime(df_mensal["Data Pagamento"], errors="coerce")
+                    # Rótulo novo em vez de ignore_index, para não invalidar o índice
+                    novo_rotulo = indice.proximo_rotulo()
+                    new_line_df = pd.DataFrame([new_row], index=[novo_rotulo])
+                    df_mensal = concat_controle_mensal([df_mensal, new_line_df])
 
                     st.session_state["controle_mensal"] = df_mensal
+                    atualizar_agregados(
+                        removidas=linhas_existentes if rotulos_removidos else None,
+                        adicionadas=df_mensal.loc[[novo_rotulo]],
+                    )
+                    indice.remover(rotulos_removidos)
+                    indice.adicionar(novo_rotulo, final_id_pag, sel_ano, sel_mes)
+                    marcar_mes_alterado(sel_ano, sel_mes)
 
                     save_controle_mensal()
                     st.success("Pagamento registrado com sucesso no Excel do SharePoint!!")
@@ -993,6 +3835,80 @@ with tab_registrar:
                 except Exception as e:
                     st.error(f"Erro ao lançar pagamento: {e}")
 
+    # Fechamento do mês: vários pagamentos de uma vez, com uma gravação por arquivo
+    with st.expander("Importação em lote (CSV/XLSX)"):
+        st.caption(
+            "Colunas obrigatórias: Fornecedor, ID - Pagamento, Ano e Mes. "
+            "As demais seguem os nomes das colunas do controle mensal."
+        )
+        arquivo_lote = st.file_uploader("Arquivo de pagamentos", type=["csv", "xlsx"], key="importacao_arquivo")
+        modo_lote = st.radio(
+            "Quando o ID de pagamento já existir no mês/ano",
+            ("Criar Novo Pagamento", "Somar com Existente"),
+            key="importacao_modo"
+        )
+        if arquivo_lote is not None:
+            conteudo_lote = arquivo_lote.getvalue()
+            assinatura_lote = (hashlib.sha1(conteudo_lote).hexdigest(), modo_lote)
+            if st.session_state.get("importacao_aplicada") == assinatura_lote:
+                st.info("Este arquivo já foi importado nesta sessão.")
+            else:
+                try:
+                    df_lote = ler_arquivo_importacao(arquivo_lote.name, conteudo_lote)
+                    validas, invalidas = validar_importacao(df_lote, st.session_state.suppliers_data)
+                except Exception as e:
+                    st.error(f"Erro ao ler o arquivo de importação: {e}")
+                    validas, invalidas = None, None
+
+                if invalidas is not None and not invalidas.empty:
+                    st.warning(f"{len(invalidas)} linha(s) com erro serão ignoradas:")
+                    st.dataframe(invalidas)
+                if validas is not None and validas.empty:
+                    st.info("Nenhuma linha válida para importar.")
+                elif validas is not None:
+                    garantir_anos_carregados(validas["Ano"].astype(str).unique())
+                    remover, novas, previa = planejar_importacao(
+                        st.session_state["controle_mensal"], indice_pagamentos(), validas,
+                        somar=modo_lote == "Somar com Existente"
+                    )
+                    st.write("Prévia da importação (nada foi salvo ainda):")
+                    st.dataframe(previa, hide_index=True)
+                    if st.button("Aplicar Importação e Salvar", key="importacao_aplicar"):
+                        with st.spinner("Importando pagamentos..."):
+                            aplicar_importacao(remover, novas)
+                        st.session_state["importacao_aplicada"] = assinatura_lote
+
+    # Pagamentos recorrentes do mês gerados a partir dos contratos, numa gravação só
+    with st.expander("Gerar pagamentos do mês (contratos)"):
+        st.caption(
+            "Cria lançamentos PENDENTE para os contratos ativos no mês, com o Valor mensal "
+            "como Valor Estimado. IDs de pagamento já lançados no mês são ignorados."
+        )
+        anos_gerar = sorted(set(mapa_ano_arquivo()) | st.session_state.anos_carregados)
+        col_ano_gerar, col_mes_gerar = st.columns(2)
+        ano_gerar = col_ano_gerar.selectbox(
+            "Ano", anos_gerar, key="gerar_mes_ano",
+            index=anos_gerar.index(ano_padrao) if ano_padrao in anos_gerar else max(len(anos_gerar) - 1, 0)
+        )
+        mes_gerar = col_mes_gerar.selectbox("Mês", MESES_ORDENADOS, index=mes_padrao_index, key="gerar_mes_mes")
+        # A prévia lê os contratos de todos os fornecedores: só quando pedida
+        if ano_gerar and st.toggle("Montar prévia a partir dos contratos", key="gerar_mes_previa"):
+            garantir_anos_carregados([ano_gerar])
+            mes_numero = MESES_ORDENADOS.index(mes_gerar) + 1
+            projecao_mes = projetar_contratos(catalogo_fornecedores(), int(ano_gerar), mes_numero, 1)
+            novas_mes = gerar_lancamentos_do_mes(projecao_mes, indice_pagamentos(), ano_gerar, mes_gerar)
+            if novas_mes.empty:
+                st.info("Todos os pagamentos previstos para o mês já estão lançados.")
+            else:
+                st.write(f"{len(novas_mes)} lançamento(s) serão criados (nada foi salvo ainda):")
+                st.dataframe(
+                    novas_mes[["Fornecedor", "ID - Pagamento", "Categoria", "Dia Vencimento", "Valor Estimado - Real"]],
+                    hide_index=True
+                )
+                if st.button("Gerar Lançamentos e Salvar", key="gerar_mes_aplicar"):
+                    with st.spinner("Gerando pagamentos do mês..."):
+                        aplicar_importacao([], novas_mes)
+
 ###############################################################################
 # ABA 4: VISUALIZAR LANÇAMENTOS
 ###############################################################################
@@ -1000,19 +3916,25 @@ with tab_visualizar:
     st.title("Visualizar Lançamentos")
     st.write("Nesta seção, você pode visualizar e editar os lançamentos de pagamentos por ano e mês.")
 
-    df_mensal = st.session_state["controle_mensal"].copy()
-
-    anos_disponiveis = sorted(df_mensal["Ano"].unique())
+    # Anos com arquivo na pasta e os já carregados na sessão; só o ano
+    # selecionado é carregado
+    anos_disponiveis = sorted(set(mapa_ano_arquivo()) | st.session_state.anos_carregados)
     meses_disponiveis = MESES_ORDENADOS
 
     if not anos_disponiveis:
         st.info("Não há registros de pagamentos disponíveis.")
     else:
-        sel_ano = st.selectbox("Selecione o Ano", anos_disponiveis)
+        iniciais = anos_iniciais()
+        sel_ano = st.selectbox(
+            "Selecione o Ano", anos_disponiveis,
+            index=anos_disponiveis.index(iniciais[0]) if iniciais and iniciais[0] in anos_disponiveis else 0
+        )
         sel_mes = st.selectbox("Selecione o Mês", meses_disponiveis)
+        garantir_anos_carregados([sel_ano])
+        df_mensal = st.session_state["controle_mensal"]
 
         df_filtrado = df_mensal[
-            (df_mensal["Ano"] == sel_ano) &
+            (df_mensal["Ano"] == int(sel_ano)).fillna(False) &
             (df_mensal["Mes"] == sel_mes)
         ]
 
@@ -1031,37 +3953,210 @@ with tab_visualizar:
                 "Observações"
             ]
 
-            df_filtrado = df_filtrado.fillna("")
-
+            # Fornecedor/ID/Categoria editáveis para que linhas novas possam ser
+            # preenchidas; Diferença é sempre recalculada ao salvar
             column_config = {
-                "Fornecedor": st.column_config.Column(disabled=True),
-                "ID - Pagamento": st.column_config.Column(disabled=True),
-                "Categoria": st.column_config.Column(disabled=True),
+                "Fornecedor": st.column_config.SelectboxColumn("Fornecedor", options=list(st.session_state.suppliers_data.keys())),
+                "ID - Pagamento": st.column_config.TextColumn("ID - Pagamento"),
+                "Categoria": st.column_config.SelectboxColumn("Categoria", options=category_options),
                 "Data Pagamento": st.column_config.DateColumn("Data Pagamento", format="DD/MM/YYYY"),
                 "Valor Estimado - Real": st.column_config.NumberColumn("Valor Estimado (R$)", format="%.2f"),
                 "Valor Pago Convertido": st.column_config.NumberColumn("Valor Pago (R$)", format="%.2f"),
-                "Diferença": st.column_config.NumberColumn("Diferença (R$)", format="%.2f"),
+                "Diferença": st.column_config.NumberColumn("Diferença (R$)", format="%.2f", disabled=True),
                 "Status de Pagamento": st.column_config.SelectboxColumn("Status", options=STATUS_PAG_OPCOES),
                 "Observações": st.column_config.TextColumn("Observações")
             }
 
+            chave_editor = f"editor_lancamentos_{sel_ano}_{sel_mes}"
+            df_exibido = df_filtrado[colunas_exibir]
             edited_df = st.data_editor(
-                df_filtrado[colunas_exibir],
+                df_exibido,
                 column_config=column_config,
                 num_rows="dynamic",
-                key=f"editor_lancamentos_{sel_ano}_{sel_mes}"
+                hide_index=True,
+                key=chave_editor
             )
 
             if st.button("Salvar Edições nos Lançamentos"):
-                with st.spinner("Salvando edições nos lançamentos..."):
-                    original_indices = df_filtrado.index
-                    edited_indices = edited_df.index
-                    removed_indices = original_indices.difference(edited_indices)
-                    if not removed_indices.empty:
-                        st.session_state["controle_mensal"] = st.session_state["controle_mensal"].drop(removed_indices)
-                    for idx in edited_indices:
-                        for col in colunas_exibir:
-                            st.session_state["controle_mensal"].loc[idx, col] = edited_df.loc[idx, col]
-                    save_controle_mensal()
-                st.success("Lançamentos atualizados com sucesso no Excel do SharePoint!")
-                st.info("Por favor, recarregue a página para visualizar os lançamentos atualizados.")
+                removidas, valores, mascara, inseridas = mudancas_do_editor(
+                    df_exibido, edited_df, st.session_state.get(chave_editor, {})
+                )
+                if removidas.empty and not mascara.to_numpy().any() and inseridas.empty:
+                    st.info("Nenhuma alteração nos lançamentos deste mês.")
+                else:
+                    with st.spinner("Salvando edições nos lançamentos..."):
+                        ignoradas = aplicar_mudancas_lancamentos(removidas, valores, mascara, inseridas, sel_ano, sel_mes)
+                        marcar_mes_alterado(sel_ano, sel_mes)
+                        save_controle_mensal()
+                    if ignoradas:
+                        st.warning(f"{ignoradas} linha(s) nova(s) sem Fornecedor ou ID - Pagamento foram ignoradas.")
+                    st.success("Lançamentos atualizados com sucesso no Excel do SharePoint!")
+                    st.info("Por favor, recarregue a página para visualizar os lançamentos atualizados.")
+
+###############################################################################
+# ABA 5: PAINEL DE GASTOS
+###############################################################################
+with tab_painel:
+    st.title("Painel de Gastos")
+    st.write("Totais de gastos por mês, categoria e fornecedor, calculados a partir dos lançamentos.")
+
+    anos_painel = sorted(set(mapa_ano_arquivo()) | st.session_state.anos_carregados)
+    if not anos_painel:
+        st.info("Não há registros de pagamentos disponíveis.")
+    else:
+        iniciais_painel = anos_iniciais()
+        ano_painel = st.selectbox(
+            "Ano", anos_painel, key="painel_ano",
+            index=anos_painel.index(iniciais_painel[0]) if iniciais_painel and iniciais_painel[0] in anos_painel else 0
+        )
+        garantir_anos_carregados([ano_painel])
+        tabela_ano = agregados_gastos().do_ano(ano_painel)
+
+        if tabela_ano.empty:
+            st.info("Não há lançamentos para o ano selecionado.")
+        else:
+            totais = tabela_ano.sum()
+            col_est, col_pago, col_dif, col_qtd = st.columns(4)
+            col_est.metric("Estimado (R$)", f"{totais['Estimado']:,.2f}")
+            col_pago.metric("Pago (R$)", f"{totais['Pago']:,.2f}")
+            col_dif.metric("Diferença (R$)", f"{totais['Diferença']:,.2f}")
+            col_qtd.metric("Lançamentos", int(round(totais["Lançamentos"])))
+
+            st.subheader("Estimado x pago por mês")
+            st.image(get_cache_graficos().obter(
+                ("mensal", ano_painel), resumo_mensal(tabela_ano), grafico_mensal
+            ))
+
+            formato_valores = {
+                col: st.column_config.NumberColumn(f"{col} (R$)", format="%.2f")
+                for col in ("Estimado", "Pago", "Diferença")
+            }
+            formato_valores["Lançamentos"] = st.column_config.NumberColumn("Lançamentos", format="%d")
+
+            col_categoria, col_planejado = st.columns(2)
+            with col_categoria:
+                st.subheader("Por categoria")
+                por_categoria = resumo_gastos(tabela_ano, "Categoria").sort_values("Pago", ascending=False)
+                por_categoria.index = por_categoria.index.map(lambda valor: valor or "(sem categoria)")
+                st.dataframe(por_categoria, column_config=formato_valores)
+            with col_planejado:
+                st.subheader("Planejado x não planejado")
+                por_planejado = resumo_gastos(tabela_ano, "Planejado")
+                por_planejado.index = por_planejado.index.map(lambda valor: valor or "(não informado)")
+                st.dataframe(por_planejado, column_config=formato_valores)
+
+            st.subheader("Por fornecedor")
+            por_fornecedor = resumo_gastos(tabela_ano, "Fornecedor").sort_values("Pago", ascending=False)
+            st.dataframe(por_fornecedor, column_config=formato_valores)
+
+        # A projeção lê os contratos de todos os fornecedores: só quando pedida
+        st.subheader("Projetado (contratos) x realizado")
+        if st.toggle("Comparar com a projeção dos contratos", key="painel_projecao"):
+            projecao = projetar_contratos(catalogo_fornecedores(), int(ano_painel), 1, 12)
+            comparacao = projetado_x_realizado(projecao, st.session_state["controle_mensal"], ano_painel)
+            if comparacao.empty:
+                st.info("Nenhum contrato ativo ou lançamento no ano selecionado.")
+            else:
+                por_mes = comparacao.groupby("Mes", observed=False)[["Projetado", "Estimado", "Pago", "Desvio"]].sum()
+                st.image(get_cache_graficos().obter(("projecao", ano_painel), por_mes, grafico_projecao))
+                formato_comparacao = {
+                    col: st.column_config.NumberColumn(f"{col} (R$)", format="%.2f")
+                    for col in ("Projetado", "Estimado", "Pago", "Desvio")
+                }
+                st.dataframe(por_mes, column_config=formato_comparacao)
+                st.dataframe(comparacao, column_config=formato_comparacao, hide_index=True)
+
+        st.subheader("Conciliação contratos x lançamentos")
+        if st.toggle("Conferir catálogo e lançamentos dos anos carregados", key="painel_conciliacao"):
+            anos_conciliacao = sorted(st.session_state.anos_carregados)
+            relatorio = conciliar(catalogo_fornecedores(), st.session_state["controle_mensal"], anos_conciliacao)
+            hoje = datetime.date.today()
+            st.caption(
+                f"Anos: {', '.join(map(str, anos_conciliacao))}. "
+                f"Parcelas faltantes só são cobradas até {hoje.month:02d}/{hoje.year}."
+            )
+            contagem = relatorio["Situação"].value_counts()
+            for coluna, situacao in zip(st.columns(len(SITUACOES_CONCILIACAO)), SITUACOES_CONCILIACAO):
+                coluna.metric(situacao.capitalize(), int(contagem.get(situacao, 0)))
+            if relatorio.empty:
+                st.success("Catálogo e lançamentos conferem.")
+            else:
+                filtro_situacoes = st.multiselect(
+                    "Situações", SITUACOES_CONCILIACAO, default=SITUACOES_CONCILIACAO, key="conciliacao_situacoes"
+                )
+                st.dataframe(
+                    relatorio[relatorio["Situação"].isin(filtro_situacoes)],
+                    column_config={
+                        col: st.column_config.NumberColumn(f"{col} (R$)", format="%.2f")
+                        for col in ("Projetado", "Estimado", "Pago")
+                    },
+                    hide_index=True,
+                )
+
+###############################################################################
+# BARRA LATERAL: ENVIOS PENDENTES E DIAGNÓSTICO DE DESEMPENHO
+###############################################################################
+ROTULOS_STATUS_TRABALHO = {
+    "queued": "⏳ na fila",
+    "uploading": "⬆️ enviando",
+    "done": "✅ enviado",
+    "failed": "⚠️ falhou (nova tentativa automática)",
+}
+
+def painel_envios():
+    """
+    Status dos últimos saves desta sessão e dos arquivos com envio pendente.
+    Roda como fragmento: só ele é reexecutado enquanto houver envio em aberto.
+    """
+    journal = get_journal()
+    for trabalho in journal.status_trabalhos(st.session_state.trabalhos_salvamento[-5:]):
+        nome_arquivo = posixpath.basename(trabalho["arquivo"])
+        st.caption(f"Trabalho #{trabalho['id']} · {nome_arquivo}: {ROTULOS_STATUS_TRABALHO[trabalho['status']]}")
+    for pendencia in journal.situacao():
+        nome_arquivo = posixpath.basename(pendencia["arquivo"])
+        if pendencia["bloqueado"]:
+            espera = max(0, int(pendencia["proxima_tentativa"] - time.time()))
+            st.warning(
+                f"{nome_arquivo}: arquivo bloqueado (aberto no Excel?). "
+                f"{pendencia['pendentes']} alteração(ões) guardadas; nova tentativa em {espera} s."
+            )
+        elif pendencia["ultimo_erro"]:
+            st.error(f"{nome_arquivo}: falha no envio ({pendencia['ultimo_erro']}). As alterações estão guardadas e serão reenviadas.")
+        else:
+            st.info(f"{nome_arquivo}: {pendencia['pendentes']} alteração(ões) aguardando envio ao SharePoint.")
+
+envios_em_aberto = any(
+    t["status"] != "done"
+    for t in get_journal().status_trabalhos(st.session_state.trabalhos_salvamento[-5:])
+)
+with st.sidebar:
+    st.fragment(painel_envios, run_every=2 if envios_em_aberto else None)()
+
+with st.sidebar.expander("Diagnóstico de desempenho"):
+    if STORAGE_BACKEND == "local":
+        st.caption(f"Backend local: {STORAGE_LOCAL_DIR}")
+    else:
+        metricas_sp = dict(get_sharepoint_client().metricas)
+        n_req = metricas_sp["requisicoes"]
+        st.write(f"Handshakes de autenticação: {metricas_sp['handshakes']} ({metricas_sp['tempo_handshakes_s']:.2f} s)")
+        st.write(f"Requisições ao SharePoint: {n_req} (média {metricas_sp['tempo_requisicoes_s'] / n_req if n_req else 0:.3f} s)")
+        st.write(f"Retentativas: {metricas_sp['retentativas']}")
+
+    cache_graficos = get_cache_graficos()
+    st.caption(
+        f"Gráficos em cache: {len(cache_graficos)}/{cache_graficos.capacidade} "
+        f"(reaproveitados {cache_graficos.acertos}x, renderizados {cache_graficos.renderizacoes}x)"
+    )
+
+    if st.button("Benchmark dos conversores (100 mil linhas)", key="bench_conversores"):
+        with st.spinner("Medindo conversores..."):
+            st.dataframe(benchmark_conversores(100_000), hide_index=True)
+
+    if st.button("Memória do controle mensal", key="memoria_controle"):
+        st.dataframe(relatorio_memoria_controle(st.session_state["controle_mensal"]), hide_index=True)
+
+    anos_bench = anos_iniciais()
+    if anos_bench and st.button(f"Pico de memória na leitura ({anos_bench[0]})", key="memoria_leitura"):
+        with st.spinner("Medindo leitura do controle mensal..."):
+            conteudo_bench = get_storage().open_bytes(mapa_ano_arquivo()[anos_bench[0]])
+            st.dataframe(benchmark_leitura_controle(anos_bench[0], conteudo_bench), hide_index=True)